@@ -8,12 +8,14 @@ from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from pymongo import MongoClient
+from app.cache import FragmentCache
+from app.metrics import Metrics
+from app.mongo import Mongo
+from app.slowlog import SlowQueryLog
 
 
-mongo = MongoClient(os.environ.get('MONGODB_URI') or 'mongodb://localhost:27017/microblog')
-db = mongo.microblog
-db.users.create_index([('username', 1)], unique=True)
+mongo = Mongo()
+db = mongo.database
 login = LoginManager()
 login.login_view = 'auth.login'
 login.login_message = _l('Please log in to access this page.')
@@ -22,6 +24,9 @@ mail = Mail()
 bootstrap = Bootstrap()
 moment = Moment()
 babel = Babel()
+fragment_cache = FragmentCache()
+metrics = Metrics()
+slow_queries = SlowQueryLog()
 
 
 
@@ -29,11 +34,15 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    mongo.init_app(app)
+    metrics.init_app(app, mongo)
+    slow_queries.init_app(app, mongo)
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
+    fragment_cache.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -47,6 +56,18 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    from app.models import user_summaries, token_cache, last_seen_buffer, notification_pubsub
+    user_summaries.configure(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+    token_cache.configure(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+    last_seen_buffer.init_app(app)
+    notification_pubsub.init_app(app)
+
+    from app.email import mail_queue
+    mail_queue.init_app(app)
+
+    from app.search import create_engine
+    app.search_engine = create_engine(app, db)
+
     if not app.debug:
         if app.config['MAIL_SERVER']:
             auth = None
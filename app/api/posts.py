@@ -0,0 +1,85 @@
+from datetime import datetime, timezone
+from flask import jsonify, request, current_app
+from app.models import Post
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+
+
+def post_document(data, author):
+    """Validate one submitted post, returning ``(document, error)``."""
+    if not isinstance(data, dict):
+        return None, 'post must be an object'
+    body = data.get('body')
+    if not isinstance(body, str) or not body.strip():
+        return None, 'body is required'
+    if len(body) > current_app.config['POST_MAX_LENGTH']:
+        return None, 'body is longer than {} characters'.format(current_app.config['POST_MAX_LENGTH'])
+
+    now = datetime.utcnow()
+    timestamp = now
+    if data.get('timestamp') is not None:
+        # importers keep the original time, stored as naive UTC like every other timestamp
+        try:
+            timestamp = datetime.fromisoformat(str(data['timestamp']))
+        except ValueError:
+            return None, 'timestamp must be ISO 8601'
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        if timestamp > now:
+            return None, 'timestamp is in the future'
+
+    return {'body': body, 'user_id': author._id, 'timestamp': timestamp}, None
+
+
+def post_result(document):
+    return {'id': str(document['_id']), 'timestamp': document['timestamp'].isoformat() + 'Z'}
+
+
+@bp.route('/posts', methods=['POST'])
+@token_auth.login_required
+def create_post():
+    author = token_auth.current_user()
+    document, error = post_document(request.get_json(silent=True), author)
+    if error:
+        return bad_request(error)
+
+    failed = Post.publish(author, [document])
+    if failed:
+        return jsonify({'error': 'Internal Server Error', 'message': failed[0]}), 500
+    return jsonify(post_result(document)), 201
+
+
+@bp.route('/posts/batch', methods=['POST'])
+@token_auth.login_required
+def create_posts():
+    data = request.get_json(silent=True)
+    items = data.get('posts') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return bad_request('expected a non-empty list of posts')
+    if len(items) > current_app.config['API_POSTS_BATCH_MAX']:
+        return bad_request('at most {} posts per batch'.format(current_app.config['API_POSTS_BATCH_MAX']))
+
+    author = token_auth.current_user()
+    results = [None] * len(items)
+    documents, positions = [], []
+    for position, item in enumerate(items):
+        document, error = post_document(item, author)
+        if error:
+            results[position] = {'status': 400, 'error': error}
+        else:
+            documents.append(document)
+            positions.append(position)
+
+    failed = Post.publish(author, documents)
+    for index, document in enumerate(documents):
+        if index in failed:
+            results[positions[index]] = {'status': 500, 'error': failed[index]}
+        else:
+            results[positions[index]] = dict(post_result(document), status=201)
+
+    created = sum(1 for result in results if result['status'] == 201)
+    response = jsonify({'created': created, 'failed': len(results) - created, 'results': results})
+    # 207 tells clients to look at the per-item statuses
+    response.status_code = 201 if created == len(results) else 207
+    return response
@@ -0,0 +1,18 @@
+from flask import jsonify
+from app import fragment_cache
+from app.api import bp
+from app.email import mail_queue
+from app.api.auth import token_auth
+from app.models import user_summaries, token_cache, notification_pubsub
+
+
+@bp.route('/stats', methods=['GET'])
+@token_auth.login_required
+def get_stats():
+    return jsonify({
+        'user_summaries': user_summaries.stats(),
+        'tokens': token_cache.stats(),
+        'fragments': fragment_cache.stats(),
+        'mail': mail_queue.stats(),
+        'events': notification_pubsub.stats()
+    })
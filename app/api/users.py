@@ -1,18 +1,23 @@
-from flask import jsonify, request, abort
+from flask import jsonify, request, abort, url_for, current_app, Response, stream_with_context
 from app import db
 from app.models import User
 from app.api import bp
 from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.conditional import make_etag, conditional, not_modified
 
 
 @bp.route('/users/<id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    user_data = db.users.find_one({'_id': id})
-
-    if user_data:
-        user = User(user_data)
-        return jsonify(user.to_dict(include_email=True))
+    user = User.find_by_id(id)
+
+    if user:
+        etag = make_etag('user', user._id, user.updated_at)
+        response = not_modified(etag, user.updated_at)
+        if response:
+            return response
+        return conditional(jsonify(user.to_dict(include_email=True)), etag, user.updated_at)
     else:
         return jsonify({'error': 'User not found'}), 404
 
@@ -20,25 +25,114 @@ def get_user(id):
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    user_data_list = db.users.find() 
+    fields = [field for field in request.args.get('fields', '').split(',') if field]
+    unknown = [field for field in fields if field not in User.API_FIELDS]
+    if unknown:
+        return bad_request('unknown fields: {}'.format(', '.join(unknown)))
+    fields = fields or User.API_FIELDS
+
+    if 'ids' in request.args:
+        return lookup_users([id for id in request.args['ids'].split(',') if id], fields)
+
+    stream = request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+    limit = request.args.get('limit', type=int)
+    if stream:
+        if limit is not None and limit < 1:
+            return bad_request('limit must be positive')
+    else:
+        # limit(0) means no limit at all, so never let it reach the cursor
+        limit = max(1, min(limit or current_app.config['API_USERS_PER_PAGE'],
+                           current_app.config['API_USERS_MAX_PER_PAGE']))
+    after = request.args.get('after')
+
+    # validated by the etag alone, a listing changes too often for one-second Last-Modified dates
+    latest = db.users.find_one({}, {'updated_at': 1}, sort=[('updated_at', -1)])
+    etag = make_etag('users', db.users.estimated_document_count(), latest.get('updated_at') if latest else None,
+                     stream, request.query_string)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    query = {'_id': {'$gt': after}} if after else {}
+    cursor = db.users.find(
+        query, User.api_projection(fields), batch_size=current_app.config['API_STREAM_BATCH_SIZE']
+    ).sort('_id', 1)
+
+    if stream:
+        if limit:
+            cursor = cursor.limit(limit)
+
+        def generate():
+            lines = []
+            for user_data in cursor:
+                lines.append(current_app.json.dumps(User.dict_from_data(user_data, True, fields)))
+                if len(lines) >= current_app.config['API_STREAM_BATCH_SIZE']:
+                    yield '\n'.join(lines) + '\n'
+                    lines = []
+            if lines:
+                yield '\n'.join(lines) + '\n'
+
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        return conditional(response, etag)
+
+    user_data_list = list(cursor.limit(limit + 1))
+    users = [User.dict_from_data(user_data, True, fields) for user_data in user_data_list[:limit]]
+
+    response = conditional(jsonify(users), etag)
+    if len(user_data_list) > limit:
+        next_url = url_for('api.get_users', after=user_data_list[limit - 1]['_id'], limit=limit,
+                           fields=request.args.get('fields'), _external=True)
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
+
+
+@bp.route('/users/lookup', methods=['POST'])
+@token_auth.login_required
+def lookup():
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list):
+        return bad_request('ids must be a list')
+
+    fields = data.get('fields') or User.API_FIELDS
+    if not isinstance(fields, (list, tuple)) or not all(isinstance(field, str) for field in fields):
+        return bad_request('fields must be a list of strings')
+    unknown = [field for field in fields if field not in User.API_FIELDS]
+    if unknown:
+        return bad_request('unknown fields: {}'.format(', '.join(unknown)))
 
-    users = []
-    for user_data in user_data_list:
-        user = User(user_data)
-        users.append(user.to_dict(include_email=True))
+    return lookup_users([str(id) for id in ids], fields)
 
-    return jsonify(users)
+
+def lookup_users(ids, fields):
+    if len(ids) > current_app.config['API_LOOKUP_MAX_IDS']:
+        return bad_request('at most {} ids per lookup'.format(current_app.config['API_LOOKUP_MAX_IDS']))
+
+    found = {
+        user_data['_id']: User.dict_from_data(user_data, True, fields)
+        for user_data in db.users.find({'_id': {'$in': list(set(ids))}}, User.api_projection(fields))
+    }
+    return jsonify({
+        'users': [found.get(id) for id in ids],
+        'missing': [id for id in ids if id not in found]
+    })
 
 
 @bp.route('/users/<id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
-    user_data = db.users.find_one({'_id': id})
+    user_data = User.find_by_id(id)
 
     if user_data:
-        followers = user_data.get('followers', [])
+        etag = make_etag('followers', user_data._id, user_data.updated_at)
+        response = not_modified(etag, user_data.updated_at)
+        if response:
+            return response
+
+        followers = list(user_data.follower_ids())
 
-        return jsonify({'followers': followers})
+        return conditional(jsonify({'followers': followers}), etag, user_data.updated_at)
     else:
         return jsonify({"error": "Usuario no encontrado"}), 404
 
@@ -46,11 +140,16 @@ def get_followers(id):
 @bp.route('/users/<id>/followed', methods=['GET'])
 @token_auth.login_required
 def get_followed(id):
-    user_data = db.users.find_one({'_id': id})
+    user_data = User.find_by_id(id)
     if user_data:
-        following = user_data.get('following', [])
+        etag = make_etag('followed', user_data._id, user_data.updated_at)
+        response = not_modified(etag, user_data.updated_at)
+        if response:
+            return response
 
-        return jsonify({'following': following})
+        following = list(user_data.following_ids())
+
+        return conditional(jsonify({'following': following}), etag, user_data.updated_at)
     else:
         return jsonify({"error": "Usuario no encontrado"}), 404
     
@@ -80,18 +179,17 @@ def create_user():
 def update_user(id):
     data = request.json
 
-    user = db.users.find_one({'_id': id})
-
-    user_data = User(user)
+    user_data = User.find_by_id(id)
 
     if user_data:
         user_data.from_dict(data)
 
         user_data.update()
+        User.invalidate(user_data)
 
         response = {
             'message': 'Usuario actualizado exitosamente',
-            'user_id': str(user._id)
+            'user_id': str(user_data._id)
         }
 
         return jsonify(response), 200
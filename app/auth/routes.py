@@ -1,3 +1,4 @@
+import queue
 from bson import ObjectId
 from flask import render_template, redirect, url_for, flash, request
 from werkzeug.urls import url_parse
@@ -88,7 +89,11 @@ def reset_password_request():
         email_user = User.find_by_email(form.email.data)
 
         if email_user:
-            send_password_reset_email(email_user)
+            try:
+                send_password_reset_email(email_user)
+            except queue.Full:
+                flash(_('We are sending a lot of email right now, please try again in a few minutes.'))
+                return redirect(url_for('auth.reset_password_request'))
             flash(_('Check your email for the instructions to reset your password'))
         else:
             flash(_('This user not exists'))
@@ -0,0 +1,223 @@
+import bisect
+import itertools
+import re
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from time import perf_counter
+from bson import ObjectId
+from werkzeug.security import generate_password_hash
+from app.models import User, user_collection, post_collection, mess_collection, follow_collection
+
+WORDS = ('mongo flask python index query cursor shard replica cache timeline follow post message search '
+         'latency throughput worker thread pool batch stream token page profile avatar night morning coffee '
+         'release deploy bug fix test merge review idea weekend travel music book film game').split()
+
+
+def _insert(collection, documents, batch_size):
+    for start in range(0, len(documents), batch_size):
+        collection.insert_many(documents[start:start + batch_size], ordered=False)
+
+
+def _sentence(rng, low=4, high=20):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high))).capitalize()
+
+
+def seed(users, posts, messages, follows, exponent, prefix, batch_size, rng, days=30):
+    """Generate a synthetic social graph and return per-collection counts.
+
+    Followees are drawn with weight 1/rank**exponent, so a handful of
+    accounts collect most followers, and out-degrees are Pareto distributed
+    around ``follows``.
+    """
+    password_hash = generate_password_hash(prefix + 'password')
+    ids = [str(ObjectId()) for _ in range(users)]
+    followers_count = dict.fromkeys(ids, 0)
+    following_count = dict.fromkeys(ids, 0)
+    unread_messages = dict.fromkeys(ids, 0)
+    now = datetime.utcnow()
+
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(users)))
+    edges = []
+    for follower in ids:
+        # paretovariate(1.5) has mean 3
+        degree = min(users - 1, int(rng.paretovariate(1.5) * follows / 3))
+        followees = set()
+        while len(followees) < degree:
+            followee = ids[bisect.bisect(cum_weights, rng.random() * cum_weights[-1])]
+            if followee != follower:
+                followees.add(followee)
+        for followee in followees:
+            edges.append({'follower': follower, 'followee': followee, 'timestamp': now})
+            followers_count[followee] += 1
+            following_count[follower] += 1
+
+    post_documents = []
+    for user_id in ids:
+        for _ in range(int(rng.expovariate(1 / posts)) if posts else 0):
+            post_documents.append({
+                '_id': ObjectId(),
+                'body': _sentence(rng),
+                'user_id': user_id,
+                'timestamp': now - timedelta(seconds=rng.uniform(0, days * 86400))
+            })
+
+    message_documents = []
+    for _ in range(messages if users > 1 else 0):
+        sender, recipient = rng.sample(ids, 2)
+        message_documents.append({
+            'sender_id': sender,
+            'recipient_id': recipient,
+            'body': _sentence(rng),
+            'timestamp': now - timedelta(seconds=rng.uniform(0, days * 86400))
+        })
+        unread_messages[recipient] += 1
+
+    user_documents = []
+    for i, user_id in enumerate(ids):
+        user = User({
+            '_id': user_id,
+            'username': '{}{}'.format(prefix, i),
+            'email': '{}{}@example.com'.format(prefix, i),
+            'password_hash': password_hash,
+            'about_me': _sentence(rng, 2, 8),
+            'last_seen': now,
+            'followers_count': followers_count[user_id],
+            'following_count': following_count[user_id],
+            'unread_messages': unread_messages[user_id],
+            'updated_at': now
+        })
+        user_documents.append(dict(user.__dict__))
+
+    _insert(user_collection, user_documents, batch_size)
+    _insert(follow_collection, edges, batch_size)
+    _insert(post_collection, post_documents, batch_size)
+    _insert(mess_collection, message_documents, batch_size)
+    return {
+        'users': len(user_documents),
+        'follows': len(edges),
+        'posts': len(post_documents),
+        'messages': len(message_documents)
+    }
+
+
+def prefix_query(prefix):
+    return {'username': {'$regex': '^' + re.escape(prefix)}}
+
+
+def clear(prefix):
+    ids = [user_data['_id'] for user_data in user_collection.find(prefix_query(prefix), {'_id': 1})]
+    for start in range(0, len(ids), 1000):
+        chunk = ids[start:start + 1000]
+        follow_collection.delete_many({'$or': [{'follower': {'$in': chunk}}, {'followee': {'$in': chunk}}]})
+        post_collection.delete_many({'user_id': {'$in': chunk}})
+        mess_collection.delete_many({'$or': [{'sender_id': {'$in': chunk}}, {'recipient_id': {'$in': chunk}}]})
+        user_collection.delete_many({'_id': {'$in': chunk}})
+    return len(ids)
+
+
+def route_paths(user, other, token):
+    """(name, path, headers) for every route the benchmark drives."""
+    api = {'Authorization': 'Bearer ' + token}
+    return [
+        ('index', '/index', {}),
+        ('explore', '/explore', {}),
+        ('user', '/user/' + other.username, {}),
+        ('user_popup', '/user/{}/popup'.format(other.username), {}),
+        ('messages', '/messages', {}),
+        ('api_user', '/api/users/' + other._id, api),
+        ('api_users', '/api/users', api),
+        ('api_followers', '/api/users/{}/followers'.format(other._id), api),
+        ('api_followed', '/api/users/{}/followed'.format(user._id), api),
+    ]
+
+
+def session_cookie(app, user):
+    # the same signed cookie Flask-Login would set after a form login
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({'_user_id': user._id, '_fresh': True})
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(fraction * len(timings)))]
+
+
+def run_route(factory, path, headers, requests, concurrency):
+    """Issue ``requests`` GETs over ``concurrency`` threads and summarize them.
+
+    ``factory()`` builds one ``get(path, headers) -> status`` per thread so
+    clients are never shared.
+    """
+    timings = []
+    errors = []
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def work():
+        client = factory()
+        local, failed = [], 0
+        while next(counter) < requests:
+            start = perf_counter()
+            status = client(path, headers)
+            local.append(perf_counter() - start)
+            # every benchmarked route answers 200 to a logged-in user, a redirect means the login was lost
+            if status >= 300:
+                failed += 1
+        with lock:
+            timings.extend(local)
+            errors.append(failed)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(work) for _ in range(concurrency)]:
+            future.result()
+    elapsed = perf_counter() - start
+
+    timings.sort()
+    if not timings:
+        return {'path': path, 'requests': 0, 'errors': sum(errors), 'throughput': 0.0, 'mean_ms': 0.0,
+                'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+    return {
+        'path': path,
+        'requests': len(timings),
+        'errors': sum(errors),
+        'throughput': len(timings) / elapsed if elapsed else 0.0,
+        'mean_ms': 1000 * sum(timings) / len(timings),
+        'p50_ms': 1000 * percentile(timings, 0.50),
+        'p95_ms': 1000 * percentile(timings, 0.95),
+        'p99_ms': 1000 * percentile(timings, 0.99),
+        'max_ms': 1000 * timings[-1]
+    }
+
+
+def test_client_factory(app, cookie):
+    def factory():
+        client = app.test_client()
+        client.set_cookie(app.config['SESSION_COOKIE_NAME'], cookie)
+
+        def get(path, headers):
+            return client.get(path, headers=headers).status_code
+        return get
+    return factory
+
+
+def http_factory(url, cookie_name, cookie):
+    import requests as http
+
+    def factory():
+        session = http.Session()
+        session.cookies.set(cookie_name, cookie)
+
+        def get(path, headers):
+            response = session.get(url.rstrip('/') + path, headers=headers, allow_redirects=False)
+            return response.status_code
+        return get
+    return factory
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
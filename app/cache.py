@@ -0,0 +1,163 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import monotonic, perf_counter
+
+
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize, ttl):
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._trim()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            self._trim()
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+    def _trim(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class MemoryBackend:
+    def __init__(self, maxsize=1024, ttl=600):
+        self._cache = TTLCache(maxsize, ttl)
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self._cache.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self._cache.delete(key)
+
+
+class MongoBackend:
+    """Shared store for every worker, expired by a TTL index on expires_at."""
+
+    def __init__(self, collection, ttl=600):
+        self.collection = collection
+        self.ttl = timedelta(seconds=ttl)
+
+    def get_many(self, keys):
+        query = {'_id': {'$in': list(keys)}, 'expires_at': {'$gt': datetime.utcnow()}}
+        return {doc['_id']: (doc['html'], doc['render_time']) for doc in self.collection.find(query)}
+
+    def set(self, key, value):
+        html, render_time = value
+        self.collection.replace_one(
+            {'_id': key},
+            {'html': html, 'render_time': render_time, 'expires_at': datetime.utcnow() + self.ttl},
+            upsert=True
+        )
+
+    def delete_many(self, keys):
+        self.collection.delete_many({'_id': {'$in': list(keys)}})
+
+
+class FragmentCache:
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+        self.hits = 0
+        self.misses = 0
+        self.render_time = 0.0
+        self.render_time_saved = 0.0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        size = app.config['FRAGMENT_CACHE_SIZE']
+        ttl = app.config['FRAGMENT_CACHE_TTL']
+        if app.config['FRAGMENT_CACHE_BACKEND'] == 'mongo':
+            from app import db
+            self.backend = MongoBackend(db.fragments, ttl)
+        else:
+            self.backend = MemoryBackend(size, ttl)
+
+    def render(self, key, render):
+        return self.render_many([(key, render)])[0]
+
+    def render_many(self, fragments):
+        cached = self.backend.get_many([key for key, render in fragments])
+        results = []
+        for key, render in fragments:
+            if key in cached:
+                html, render_time = cached[key]
+                with self._lock:
+                    self.hits += 1
+                    self.render_time_saved += render_time
+            else:
+                start = perf_counter()
+                html = render()
+                render_time = perf_counter() - start
+                self.backend.set(key, (html, render_time))
+                with self._lock:
+                    self.misses += 1
+                    self.render_time += render_time
+            results.append(html)
+        return results
+
+    def delete(self, *keys):
+        self.backend.delete_many(keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'render_seconds': self.render_time,
+                'render_seconds_saved': self.render_time_saved
+            }
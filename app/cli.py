@@ -1,5 +1,18 @@
+import json
 import os
+import random
 import click
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from bson import ObjectId
+from datetime import datetime
+from flask import current_app
+from pymongo import UpdateOne
+from app import bench as benchmarks, transfer
+from app.indexes import sync_indexes, missing_indexes, explain_queries
+from app.models import User, Post, Timeline, user_collection, post_collection, follow_collection, \
+    checkpoint_collection, recount_follows
 
 
 def register(app):
@@ -32,4 +45,356 @@ def register(app):
     def compile():
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
-            raise RuntimeError('compile command failed')
\ No newline at end of file
+            raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def timeline():
+        """Home timeline maintenance commands."""
+        pass
+
+    @timeline.command()
+    def rebuild():
+        """Rebuild every user's home timeline from the posts collection."""
+        count = 0
+        for user_data in user_collection.find():
+            Timeline.rebuild(User(user_data))
+            count += 1
+        click.echo('Rebuilt {} timelines.'.format(count))
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.option('--batch-size', default=1000, help='Posts per bulk write to the index.')
+    @click.option('--workers', default=4, help='Concurrent bulk writers.')
+    @click.option('--restart', is_flag=True, help='Ignore the checkpoint and index every post.')
+    def reindex(batch_size, workers, restart):
+        """Stream every post into the search index, resuming from the last checkpoint."""
+        engine = current_app.search_engine
+        checkpoint_id = 'search:posts'
+        if restart:
+            checkpoint_collection.delete_one({'_id': checkpoint_id})
+        checkpoint = checkpoint_collection.find_one({'_id': checkpoint_id})
+        query = {'_id': {'$gt': checkpoint['last_id']}} if checkpoint else {}
+        if checkpoint:
+            click.echo('Resuming after post {}.'.format(checkpoint['last_id']))
+
+        projection = dict.fromkeys(Post.__searchable__ + ['timestamp'], 1)
+        cursor = post_collection.find(query, projection).sort('_id', 1).batch_size(batch_size)
+
+        # futures complete out of order, so the checkpoint only advances past
+        # the oldest batch once it and everything before it has been written
+        in_flight = deque()
+
+        def settle(block):
+            while in_flight and (block or in_flight[0][0].done()):
+                future, last_id = in_flight.popleft()
+                future.result()
+                checkpoint_collection.update_one(
+                    {'_id': checkpoint_id}, {'$set': {'last_id': last_id, 'updated_at': datetime.utcnow()}},
+                    upsert=True)
+                block = False
+
+        indexed = 0
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            batch = []
+            for post_data in cursor:
+                batch.append(Post.search_document(post_data))
+                if len(batch) < batch_size:
+                    continue
+                if len(in_flight) >= workers * 2:
+                    settle(True)
+                in_flight.append((executor.submit(engine.add, 'posts', batch), batch[-1]['_id']))
+                indexed += len(batch)
+                batch = []
+                settle(False)
+                elapsed = perf_counter() - start
+                click.echo('{} posts, {:.0f} docs/s'.format(indexed, indexed / elapsed if elapsed else 0))
+            if batch:
+                in_flight.append((executor.submit(engine.add, 'posts', batch), batch[-1]['_id']))
+                indexed += len(batch)
+            while in_flight:
+                settle(True)
+
+        elapsed = perf_counter() - start
+        click.echo('Indexed {} posts in {:.2f}s: {:.0f} docs/s'.format(
+            indexed, elapsed, indexed / elapsed if elapsed else 0))
+
+    @app.cli.group('db')
+    def database():
+        """Database maintenance commands."""
+        pass
+
+    @database.group()
+    def indexes():
+        """Declarative index registry commands."""
+        pass
+
+    @indexes.command()
+    def sync():
+        """Create every registered index."""
+        for collection, names in sync_indexes().items():
+            click.echo('{}: {}'.format(collection, ', '.join(names)))
+
+    @indexes.command()
+    def check():
+        """Verify registered indexes exist and no model query scans a collection."""
+        failed = False
+
+        for collection, name in missing_indexes():
+            click.echo('missing index {}.{}'.format(collection, name))
+            failed = True
+
+        for description, collection, stages in explain_queries():
+            status = 'COLLSCAN' if 'COLLSCAN' in stages else 'ok'
+            click.echo('{:<8} {} ({})'.format(status, description, ', '.join(sorted(stages))))
+            if status == 'COLLSCAN':
+                failed = True
+
+        if failed:
+            raise click.ClickException('index check failed')
+
+    @database.command('migrate-follows')
+    @click.option('--batch-size', default=1000, help='Writes per bulk_write.')
+    def migrate_follows(batch_size):
+        """Move embedded followers/following arrays into the follows collection."""
+        embedded = {'$or': [{'followers': {'$exists': True}}, {'following': {'$exists': True}}]}
+
+        def write(requests):
+            # an edge listed on both of its users is upserted twice but only created once
+            if requests:
+                return follow_collection.bulk_write(requests, ordered=False).upserted_count
+            return 0
+
+        requests = []
+        edges = 0
+        for user_data in user_collection.find(embedded, {'followers': 1, 'following': 1}):
+            pairs = [(user_data['_id'], followee) for followee in user_data.get('following', [])]
+            pairs += [(follower, user_data['_id']) for follower in user_data.get('followers', [])]
+            for follower, followee in pairs:
+                if follower == followee:
+                    continue
+                requests.append(UpdateOne(
+                    {'follower': follower, 'followee': followee},
+                    {'$setOnInsert': {'timestamp': datetime.utcnow()}},
+                    upsert=True
+                ))
+                if len(requests) >= batch_size:
+                    edges += write(requests)
+                    requests = []
+        edges += write(requests)
+
+        recount_follows(batch_size=batch_size)
+
+        result = user_collection.update_many(embedded, {'$unset': {'followers': '', 'following': ''}})
+        click.echo('Migrated {} edges from {} users.'.format(edges, result.modified_count))
+
+    @app.cli.command()
+    @click.option('--users', default=1000, help='Accounts to create.')
+    @click.option('--posts', default=20, help='Mean posts per user.')
+    @click.option('--messages', default=5000, help='Private messages to create.')
+    @click.option('--follows', default=30, help='Mean accounts followed per user.')
+    @click.option('--exponent', default=1.1, help='Power-law exponent of followee popularity.')
+    @click.option('--prefix', default='seed-', help='Username prefix marking generated accounts.')
+    @click.option('--batch-size', default=1000, help='Documents per insert_many.')
+    @click.option('--random-seed', default=None, type=int, help='Make the generated data reproducible.')
+    @click.option('--clear', is_flag=True, help='Delete accounts from a previous run with the same prefix first.')
+    @click.option('--timelines/--no-timelines', default=True, help='Rebuild home timelines for the new accounts.')
+    def seed(users, posts, messages, follows, exponent, prefix, batch_size, random_seed, clear, timelines):
+        """Bulk-generate users, posts, messages and a power-law follow graph."""
+        if clear:
+            click.echo('Removed {} accounts.'.format(benchmarks.clear(prefix)))
+
+        start = perf_counter()
+        counts = benchmarks.seed(users, posts, messages, follows, exponent, prefix, batch_size,
+                                 random.Random(random_seed))
+        click.echo('Inserted {} in {:.2f}s.'.format(
+            ', '.join('{} {}'.format(count, name) for name, count in counts.items()), perf_counter() - start))
+
+        if timelines:
+            start = perf_counter()
+            for user_data in user_collection.find(benchmarks.prefix_query(prefix)):
+                Timeline.rebuild(User(user_data))
+            click.echo('Rebuilt timelines in {:.2f}s.'.format(perf_counter() - start))
+        click.echo("Password for every account: '{}password'.".format(prefix))
+
+    @app.cli.group()
+    def data():
+        """Per-user export and bulk import."""
+        pass
+
+    def stream_format(path, format):
+        if format:
+            return format
+        return 'bson' if path.endswith('.bson') else 'jsonl'
+
+    def progress(count, start, final=False):
+        elapsed = perf_counter() - start
+        click.echo('{}{} documents, {:.0f} docs/s'.format(
+            'Done: ' if final else '', count, count / elapsed if elapsed else 0), err=True)
+
+    @data.command('export')
+    @click.argument('username')
+    @click.argument('output', type=click.File('wb'), default='-')
+    @click.option('--format', type=click.Choice(['jsonl', 'bson']), default=None,
+                  help='Defaults to bson for .bson files, JSON Lines otherwise.')
+    @click.option('--batch-size', default=1000, help='Cursor batch size.')
+    def export_data(username, output, format, batch_size):
+        """Stream a user's profile, posts, messages and follows to OUTPUT."""
+        user = User.find_by_username(username)
+        if user is None:
+            raise click.ClickException('no user named {!r}'.format(username))
+
+        count = 0
+        start = perf_counter()
+        records = transfer.user_records(user._id, batch_size)
+        for _ in transfer.write_records(records, output, stream_format(output.name, format)):
+            count += 1
+            if count % (batch_size * 10) == 0:
+                progress(count, start)
+        progress(count, start, final=True)
+
+    @data.command('import')
+    @click.argument('input', type=click.File('rb'))
+    @click.option('--format', type=click.Choice(['jsonl', 'bson']), default=None,
+                  help='Defaults to bson for .bson files, JSON Lines otherwise.')
+    @click.option('--batch-size', default=1000, help='Upserts per bulk_write.')
+    def import_data(input, format, batch_size):
+        """Upsert an export into this database, safe to run more than once."""
+        importer = transfer.Importer(batch_size)
+        count = 0
+        start = perf_counter()
+        for name, document in transfer.read_records(input, stream_format(input.name, format)):
+            try:
+                importer.add(name, document)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+            count += 1
+            if count % (batch_size * 10) == 0:
+                progress(count, start)
+        importer.flush()
+        importer.recount()
+        progress(count, start, final=True)
+        click.echo('Upserted {} documents.'.format(importer.written))
+
+        for name, message in importer.errors[:10]:
+            click.echo('{}: {}'.format(name, message), err=True)
+        click.echo("Run 'flask timeline rebuild' and 'flask search reindex' to pick up imported posts.")
+        if importer.errors:
+            raise click.ClickException('{} of {} documents failed'.format(len(importer.errors), count))
+
+    @app.cli.group()
+    def bench():
+        """Benchmark commands."""
+        pass
+
+    @bench.command()
+    @click.option('--requests', default=200, type=click.IntRange(min=1), help='Requests per route.')
+    @click.option('--concurrency', default=4, type=click.IntRange(min=1), help='Concurrent clients.')
+    @click.option('--prefix', default='seed-', help='Username prefix of the seeded accounts to act as.')
+    @click.option('--url', default=None, help='Base URL of a running server, e.g. a local gunicorn. '
+                                              'Defaults to the in-process test client.')
+    @click.option('--route', 'routes', multiple=True, help='Only run these routes.')
+    @click.option('--output', default='bench-routes.json', help='Where to write the JSON results.')
+    def routes(requests, concurrency, prefix, url, routes, output):
+        """Measure throughput and p50/p95/p99 latency of the main and API routes."""
+        # the most followed seeded account gives the heaviest profile pages
+        viewer_data = user_collection.find_one(benchmarks.prefix_query(prefix),
+                                               sort=[('following_count', -1)])
+        other_data = user_collection.find_one(benchmarks.prefix_query(prefix),
+                                              sort=[('followers_count', -1)])
+        if viewer_data is None:
+            raise click.ClickException("no '{}' accounts, run 'flask seed' first".format(prefix))
+        viewer, other = User(viewer_data), User(other_data)
+
+        cookie = benchmarks.session_cookie(app, viewer)
+        if url:
+            factory = benchmarks.http_factory(url, app.config['SESSION_COOKIE_NAME'], cookie)
+        else:
+            factory = benchmarks.test_client_factory(app, cookie)
+
+        results = {}
+        token = viewer.get_token()
+        try:
+            for name, path, headers in benchmarks.route_paths(viewer, other, token):
+                if routes and name not in routes:
+                    continue
+                result = benchmarks.run_route(factory, path, headers, requests, concurrency)
+                results[name] = result
+                click.echo('{:<14} {:>8.1f} req/s  p50 {:>7.2f}ms  p95 {:>7.2f}ms  p99 {:>7.2f}ms  errors {}'.format(
+                    name, result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                    result['errors']))
+        finally:
+            viewer.revoke_token()
+
+        report = {
+            'started_at': datetime.utcnow().isoformat(),
+            'revision': benchmarks.git_revision(),
+            'target': url or 'test-client',
+            'requests': requests,
+            'concurrency': concurrency,
+            'viewer': viewer.username,
+            'routes': results
+        }
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        click.echo('Wrote {}.'.format(output))
+
+    @bench.command()
+    @click.option('--users', default=20, help='Accounts taking part in the storm.')
+    @click.option('--threads', default=8, help='Concurrent clients.')
+    @click.option('--operations', default=2000, help='Total follow/unfollow calls.')
+    def follows(users, threads, operations):
+        """Run concurrent follow/unfollow storms and verify the counters."""
+        prefix = 'bench-follow-{}-'.format(os.getpid())
+        accounts = []
+        for i in range(users):
+            user = User({
+                '_id': str(ObjectId()),
+                'username': '{}{}'.format(prefix, i),
+                'email': '{}{}@example.com'.format(prefix, i),
+                'password_hash': None
+            })
+            user.save()
+            accounts.append(user)
+
+        def storm(count):
+            rng = random.Random()
+            with app.app_context():
+                for _ in range(count):
+                    follower, followee = rng.sample(accounts, 2)
+                    if rng.random() < 0.5:
+                        follower.follow(followee)
+                    else:
+                        follower.unfollow(followee)
+
+        ids = [user._id for user in accounts]
+        try:
+            start = perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                share, extra = divmod(operations, threads)
+                futures = [executor.submit(storm, share + (1 if i < extra else 0)) for i in range(threads)]
+            elapsed = perf_counter() - start
+            # a storm that died early would leave fewer operations behind the numbers below
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            if errors:
+                raise click.ClickException('{} of {} storms failed: {}'.format(len(errors), threads, errors[0]))
+
+            mismatches = 0
+            for user_data in user_collection.find({'_id': {'$in': ids}}):
+                if user_data.get('followers_count', 0) != follow_collection.count_documents({'followee': user_data['_id']}):
+                    mismatches += 1
+                if user_data.get('following_count', 0) != follow_collection.count_documents({'follower': user_data['_id']}):
+                    mismatches += 1
+        finally:
+            follow_collection.delete_many({'follower': {'$in': ids}})
+            user_collection.delete_many({'_id': {'$in': ids}})
+
+        click.echo('{} operations from {} threads in {:.2f}s: {:.1f} ops/s'.format(
+            operations, threads, elapsed, operations / elapsed))
+        click.echo('counter mismatches: {}'.format(mismatches))
+        if mismatches:
+            raise click.ClickException('follow counters drifted from the follows collection')
\ No newline at end of file
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+from hashlib import md5
+from flask import request, make_response
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(*parts):
+    return md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def settled(last_modified):
+    """Return ``last_modified`` unless it falls in the current second.
+
+    Last-Modified only has one-second resolution, so a date handed out in
+    the second it was written would also cover a later change in that
+    same second and answer it with a 304.
+    """
+    if last_modified and last_modified.replace(microsecond=0) + timedelta(seconds=1) <= datetime.utcnow():
+        return last_modified
+    return None
+
+
+def conditional(response, etag, last_modified=None):
+    response = make_response(response)
+    response.set_etag(etag)
+    last_modified = settled(last_modified)
+    if last_modified:
+        response.last_modified = last_modified
+    # clients may keep a copy but must revalidate it every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """Return a 304 response when the client's validators still match, else None."""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    # If-Modified-Since is ignored when If-None-Match is sent, the etag is exact
+    if is_resource_modified(request.environ, etag=etag, last_modified=settled(last_modified)):
+        return None
+    return conditional(('', 304), etag, last_modified)
@@ -1,16 +1,121 @@
-from threading import Thread
-from flask import current_app
+import atexit
+import queue
+import threading
+from time import perf_counter, sleep
 from flask_mail import Message
 from app import mail
+from app.threads import WorkerThreads
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class MailQueue:
+    """Bounded outbound queue drained by a fixed pool of SMTP workers."""
+
+    def __init__(self):
+        self.app = None
+        self._queue = None
+        self._workers = WorkerThreads(self._work, 'mail-worker')
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.last_latency = 0.0
+        atexit.register(self.drain)
+
+    def init_app(self, app):
+        self.app = app
+        self._workers.count = app.config['MAIL_WORKERS']
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.max_retries = app.config['MAIL_MAX_RETRIES']
+        self.retry_backoff = app.config['MAIL_RETRY_BACKOFF']
+        self.enqueue_timeout = app.config['MAIL_ENQUEUE_TIMEOUT']
+        self._queue = queue.Queue(app.config['MAIL_QUEUE_SIZE'])
+
+    def put(self, msg):
+        self._workers.start()
+        # raises queue.Full when the workers cannot keep up, right away unless a timeout is configured
+        self._queue.put((msg, perf_counter()), block=self.enqueue_timeout > 0, timeout=self.enqueue_timeout or None)
+
+    def drain(self, timeout=10):
+        if self._queue is None or not self._workers:
+            return
+        deadline = perf_counter() + timeout
+        while self._queue.unfinished_tasks and perf_counter() < deadline:
+            sleep(0.05)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self._queue.qsize() if self._queue else 0,
+                'workers': len(self._workers),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retries': self.retries,
+                'average_latency': self.latency_total / self.sent if self.sent else 0.0,
+                'last_latency': self.last_latency
+            }
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._send_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send_batch(self, batch):
+        attempt = 0
+        while batch:
+            with self.app.app_context():
+                try:
+                    # one SMTP connection for the whole batch
+                    with mail.connect() as connection:
+                        pending = []
+                        for msg, queued_at in batch:
+                            try:
+                                connection.send(msg)
+                            except Exception:
+                                self.app.logger.exception('Sending mail to %s failed', msg.recipients)
+                                pending.append((msg, queued_at))
+                            else:
+                                self._record_sent(queued_at)
+                        batch = pending
+                except Exception:
+                    self.app.logger.exception('Could not open SMTP connection')
+
+            if not batch:
+                return
+
+            attempt += 1
+            if attempt > self.max_retries:
+                with self._lock:
+                    self.failed += len(batch)
+                self.app.logger.error('Dropping %d mails after %d retries', len(batch), self.max_retries)
+                return
+
+            with self._lock:
+                self.retries += len(batch)
+            sleep(self.retry_backoff * 2 ** (attempt - 1))
+
+    def _record_sent(self, queued_at):
+        latency = perf_counter() - queued_at
+        with self._lock:
+            self.sent += 1
+            self.latency_total += latency
+            self.last_latency = latency
+
+
+mail_queue = MailQueue()
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+    mail_queue.put(msg)
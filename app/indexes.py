@@ -0,0 +1,100 @@
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from app import db
+from config import Config
+
+
+INDEXES = {
+    'users': [
+        IndexModel([('username', ASCENDING)], unique=True),
+        IndexModel([('email', ASCENDING)]),
+        # new accounts store token_hash: None, which a sparse index would still count
+        IndexModel([('token_hash', ASCENDING)], unique=True,
+                   partialFilterExpression={'token_hash': {'$type': 'string'}}),
+        IndexModel([('pull_on_read', ASCENDING)], sparse=True),
+        IndexModel([('updated_at', DESCENDING)]),
+    ],
+    'posts': [
+        IndexModel([('user_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([('timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ],
+    'messages': [
+        IndexModel([('recipient_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)]),
+        IndexModel([('sender_id', ASCENDING), ('timestamp', DESCENDING)]),
+    ],
+    'follows': [
+        IndexModel([('follower', ASCENDING), ('followee', ASCENDING)], unique=True),
+        IndexModel([('followee', ASCENDING), ('follower', ASCENDING)]),
+    ],
+    'fragments': [
+        IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0),
+    ],
+    'notifications': [
+        IndexModel([('user_id', ASCENDING), ('name', ASCENDING)], unique=True),
+        IndexModel([('user_id', ASCENDING), ('timestamp', ASCENDING)]),
+        IndexModel([('timestamp', ASCENDING)], expireAfterSeconds=Config.NOTIFICATION_TTL),
+    ],
+    'search_posts': [
+        IndexModel([('$**', TEXT)]),
+    ],
+}
+
+# (description, collection, filter, sort) for every query the models and routes run
+QUERIES = [
+    ('user by username', 'users', {'username': ''}, None),
+    ('user by email', 'users', {'email': ''}, None),
+    ('user by token hash', 'users', {'token_hash': ''}, None),
+    ('pull-on-read authors', 'users', {'pull_on_read': True}, None),
+    ('latest user change', 'users', {}, [('updated_at', DESCENDING)]),
+    ('posts by author', 'posts', {'user_id': ''}, [('timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ('latest posts', 'posts', {}, [('timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ('messages by recipient', 'messages', {'recipient_id': ''}, [('timestamp', DESCENDING), ('_id', DESCENDING)]),
+    ('messages by sender', 'messages', {'sender_id': ''}, None),
+    ('followers of user', 'follows', {'followee': ''}, None),
+    ('users followed by user', 'follows', {'follower': ''}, None),
+    ('follow edge', 'follows', {'follower': '', 'followee': ''}, None),
+    ('notifications by user and name', 'notifications', {'user_id': '', 'name': ''}, None),
+    ('notifications since', 'notifications', {'user_id': '', 'timestamp': {'$gt': datetime(1970, 1, 1)}},
+     [('timestamp', ASCENDING)]),
+    ('post search', 'search_posts', {'$text': {'$search': 'microblog'}}, None),
+]
+
+
+def sync_indexes():
+    created = {}
+    for collection, indexes in INDEXES.items():
+        created[collection] = db[collection].create_indexes(indexes)
+    return created
+
+
+def missing_indexes():
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = db[collection].index_information()
+        for index in indexes:
+            name = index.document['name']
+            if name not in existing:
+                missing.append((collection, name))
+    return missing
+
+
+def _plan_stages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+
+def explain_queries():
+    results = []
+    for description, collection, query, sort in QUERIES:
+        cursor = db[collection].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        results.append((description, collection, set(_plan_stages(plan))))
+    return results
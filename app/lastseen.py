@@ -0,0 +1,63 @@
+import atexit
+import logging
+import threading
+from pymongo import UpdateOne
+from app.threads import WorkerThreads
+
+
+class LastSeenBuffer:
+    """Keeps the newest last_seen per user in memory and writes them in bulk."""
+
+    def __init__(self, collection, flush_interval=5, max_pending=500):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.logger = logging.getLogger(__name__)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = WorkerThreads(self._run, 'last-seen-flusher')
+        atexit.register(self.flush)
+
+    def init_app(self, app):
+        self.flush_interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        self.max_pending = app.config['LAST_SEEN_FLUSH_SIZE']
+        self.logger = app.logger
+
+    def record(self, user_id, timestamp):
+        with self._lock:
+            current = self._pending.get(user_id)
+            if current is None or timestamp > current:
+                self._pending[user_id] = timestamp
+            full = len(self._pending) >= self.max_pending
+            self._flusher.start()
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        requests = [
+            UpdateOne({'_id': user_id}, {'$max': {'last_seen': timestamp, 'updated_at': timestamp}})
+            for user_id, timestamp in pending.items()
+        ]
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception:
+            self.logger.exception('last_seen flush failed, retrying on next flush')
+            with self._lock:
+                for user_id, timestamp in pending.items():
+                    current = self._pending.get(user_id)
+                    if current is None or timestamp > current:
+                        self._pending[user_id] = timestamp
+            return 0
+        return len(requests)
+
+    def _run(self):
+        stop = threading.Event()
+        while not stop.wait(self.flush_interval):
+            self.flush()
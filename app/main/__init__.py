@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('main', __name__)
 
-from app.main import routes
\ No newline at end of file
+from app.main import routes, fragments
\ No newline at end of file
@@ -0,0 +1,30 @@
+from hashlib import md5
+from flask import render_template
+from flask_babel import get_locale
+from markupsafe import Markup
+from app import fragment_cache
+from app.main import bp
+
+
+def profile_key(user, locale):
+    # updated_at moves with every profile edit, follow and flushed last_seen, so a
+    # changed profile gets a new key in every worker and stale entries just age out
+    return 'profile:{}:{}:{}'.format(user._id, locale, user.updated_at)
+
+
+@bp.app_template_global()
+def post_fragments(posts):
+    locale = str(get_locale())
+    fragments = []
+    for post in posts:
+        # author fields are part of the key, so profile edits never serve a stale row
+        author = md5('{}:{}'.format(post['user']['username'], post['user'].get('avatar_uri')).encode('utf-8'))
+        key = 'post:{}:{}:{}'.format(post['_id'], locale, author.hexdigest())
+        fragments.append((key, lambda post=post: render_template('_post.html', post=post)))
+    return [Markup(html) for html in fragment_cache.render_many(fragments)]
+
+
+@bp.app_template_global()
+def profile_fragment(user):
+    key = profile_key(user, str(get_locale()))
+    return Markup(fragment_cache.render(key, lambda: render_template('_profile.html', user=user)))
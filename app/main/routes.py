@@ -1,79 +1,66 @@
-from datetime import datetime
-from bson import ObjectId
-from flask import render_template, flash, redirect, url_for, request, g, current_app
+import json
+import queue
+from datetime import datetime, timedelta
+from time import monotonic, time
+from flask import render_template, flash, redirect, url_for, request, g, current_app, session, abort, Response, \
+    jsonify
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-import pymongo
 from app import db
-from app.main.forms import EditProfileForm, EmptyForm, PostForm, MessageForm
-from app.models import User, Message
+from app.conditional import make_etag, conditional, not_modified
+from app.main.forms import EditProfileForm, EmptyForm, PostForm, MessageForm, SearchForm
+from app.models import User, Message, Post, Notification, Timeline, last_seen_buffer, notification_pubsub, \
+    feed_pipeline
 from app.main import bp
+from app.pagination import paginate, keyset_match, keyset_sort, encode_score_cursor, decode_score_cursor
+from app.search import query_index
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
         current_user.last_seen = datetime.utcnow()
-        
-        db.users.update_one(
-            {'_id': ObjectId(current_user._id)},
-            {
-                '$set': {
-                    'last_seen': current_user.last_seen,
-                    'username': current_user.username,
-                    'about_me': current_user.about_me
-                }
-            }
-        )
+        last_seen_buffer.record(current_user._id, current_user.last_seen)
+        g.search_form = SearchForm()
         g.locale = str(get_locale())
 
 
+def user_page_etag(user):
+    # the page shows the user, plus the viewer's navbar and follow button
+    if session.get('_flashes'):
+        return None
+    # the follow form embeds a CSRF token, so a revalidated copy must never outlive it
+    csrf_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    csrf_bucket = int(time() // (csrf_limit / 2)) if csrf_limit else 0
+    return make_etag(user._id, user.updated_at, current_user._id, current_user.username,
+                     current_user.unread_messages, get_locale(), request.full_path, csrf_bucket)
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
     form = PostForm()
-    post_collection = db.posts
     if form.validate_on_submit():
         post_data ={
             'body': form.post.data,
             'user_id': current_user._id,  
-            'timestamp': datetime.utcnow(),
-            '__searchable__': form.post.data
+            'timestamp': datetime.utcnow()
         }
-        post_collection.insert_one(post_data)
+        Post.publish(current_user, [post_data])
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
     
-    page = request.args.get('page', 1, type=int)
+    page = paginate(
+        lambda cursor, newer, limit: Timeline.fetch(current_user, cursor, newer, limit),
+        current_app.config['POSTS_PER_PAGE'],
+        before=request.args.get('before'),
+        after=request.args.get('after')
+    )
+    posts = page.items
     
-    pipeline = [
-        {
-            "$lookup": {
-                "from": "users",
-                "localField": "user_id",
-                "foreignField": "_id",
-                "as": "user"
-            }
-        },
-        {
-            "$unwind": "$user"
-        },
-        {
-            "$sort": {"timestamp": -1}
-        },
-        {
-            "$skip": (page - 1) * current_app.config['POSTS_PER_PAGE']
-        },
-        {
-            "$limit": current_app.config['POSTS_PER_PAGE']
-        }
-    ]
-
-    posts = list(post_collection.aggregate(pipeline))
-    
-    next_url = url_for('main.index', page=page + 1) if len(posts) == current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.index', page=page - 1) if page > 1 else None
+    next_url = url_for('main.index', before=page.next_cursor) if page.next_cursor else None
+    prev_url = url_for('main.index', after=page.prev_cursor) if page.prev_cursor else None
 
     if len(posts) == 0:
         flash("Nadie ha posteado nada todavía")
@@ -85,37 +72,15 @@ def index():
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    
-    pipeline = [
-        {
-            "$lookup": {
-                "from": "users",
-                "localField": "user_id",
-                "foreignField": "_id",
-                "as": "user"
-            }
-        },
-        {
-            "$unwind": "$user"
-        },
-        {
-            "$sort": {"timestamp": -1}
-        },
-        {
-            "$skip": (page - 1) * current_app.config['POSTS_PER_PAGE']
-        },
-        {
-            "$limit": current_app.config['POSTS_PER_PAGE']
-        }
-    ]
-    
-    posts = list(db.posts.aggregate(pipeline))
-    
-    total_posts = db.posts.count_documents({})
+    def fetch(cursor, newer, limit):
+        return Post.fetch_feed({}, cursor, newer, limit)
+
+    page = paginate(fetch, current_app.config['POSTS_PER_PAGE'],
+                    before=request.args.get('before'), after=request.args.get('after'))
+    posts = page.items
     
-    next_url = url_for('main.explore', page=page + 1) if total_posts > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.explore', page=page - 1) if page > 1 else None
+    next_url = url_for('main.explore', before=page.next_cursor) if page.next_cursor else None
+    prev_url = url_for('main.explore', after=page.prev_cursor) if page.prev_cursor else None
 
     return render_template('index.html', title=_('Explore'), posts=posts, next_url=next_url, prev_url=prev_url, 
                            user=current_user)#en miguel no té lo de user
@@ -125,46 +90,51 @@ def explore():
 @login_required
 def user(username):
     user = User.find_by_username(username)
+    if user is None:
+        abort(404)
 
-    page = request.args.get('page', 1, type=int)
-    
-    pipeline = [
-        {
-            "$match": {
-                "user_id": user._id
-            }
-        },
-        {
-            "$lookup": {
-                "from": "users",
-                "localField": "user_id",
-                "foreignField": "_id",
-                "as": "user"
-            }
-        },
-        {
-            "$unwind": "$user"
-        },
-        {
-            "$sort": {"timestamp": -1}
-        },
-        {
-            "$skip": (page - 1) * current_app.config['POSTS_PER_PAGE']
-        },
-        {
-            "$limit": current_app.config['POSTS_PER_PAGE']
-        }
-    ]
+    etag = user_page_etag(user)
+    response = not_modified(etag) if etag else None
+    if response:
+        return response
+
+    def fetch(cursor, newer, limit):
+        return Post.fetch_feed({'user_id': user._id}, cursor, newer, limit)
 
-    posts = list(db.posts.aggregate(pipeline))
-    total_posts = db.posts.count_documents({'user_id': user._id})
+    page = paginate(fetch, current_app.config['POSTS_PER_PAGE'],
+                    before=request.args.get('before'), after=request.args.get('after'))
+    posts = page.items
     
-    next_url = url_for('main.user', username=username, page=page + 1) if total_posts > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.user', username=username, page=page - 1) if page > 1 else None
+    next_url = url_for('main.user', username=username, before=page.next_cursor) if page.next_cursor else None
+    prev_url = url_for('main.user', username=username, after=page.prev_cursor) if page.prev_cursor else None
     
     form = EmptyForm()
     
-    return render_template('user.html', user=user, posts=posts, next_url=next_url, prev_url=prev_url, form=form)
+    response = render_template('user.html', user=user, posts=posts, next_url=next_url, prev_url=prev_url, form=form)
+    return conditional(response, etag) if etag else response
+
+
+@bp.route('/search')
+@login_required
+def search():
+    if not g.search_form.validate():
+        return redirect(url_for('main.explore'))
+
+    per_page = current_app.config['POSTS_PER_PAGE']
+    q = g.search_form.q.data
+    hits = query_index('posts', q, decode_score_cursor(request.args.get('after')), per_page + 1)
+
+    rank = {_id: position for position, (_id, score) in enumerate(hits[:per_page])}
+    posts = list(db.posts.aggregate(feed_pipeline({'_id': {'$in': list(rank)}})))
+    posts.sort(key=lambda post: rank[post['_id']])
+
+    next_url = None
+    if len(hits) > per_page:
+        last_id, last_score = hits[per_page - 1]
+        next_url = url_for('main.search', q=q, after=encode_score_cursor(last_score, last_id))
+    prev_url = url_for('main.search', q=q) if request.args.get('after') else None
+
+    return render_template('search.html', title=_('Search'), posts=posts, next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -180,10 +150,12 @@ def edit_profile():
             {
                 '$set': {
                     'username': current_user.username,
-                    'about_me': current_user.about_me
+                    'about_me': current_user.about_me,
+                    'updated_at': datetime.utcnow()
                 }
             }
         )
+        User.invalidate(current_user)
 
         flash(_('Your changes have been saved.'))
         return redirect(url_for('main.edit_profile'))
@@ -210,15 +182,8 @@ def follow(username):
         if user == current_user:
             flash(_('You cannot follow yourself!'))
             return redirect(url_for('main.user', username=username))
-        
 
-        current_user_id_str = str(current_user.get_id())
-        user_id_str = str(user.get_id())
-
-        if user_id_str not in current_user.following:
-            current_user.follow(user)
-            user.followers.append(current_user_id_str)
-            user.update()
+        if current_user.follow(user):
             flash(_('You are following {}!'.format(username)))
 
         return redirect(url_for('main.user', username=username))
@@ -241,15 +206,8 @@ def unfollow(username):
         if user == current_user:
             flash(_('You cannot unfollow yourself!'))
             return redirect(url_for('main.user', username=username))
-        
-        current_user_id_str = str(current_user.get_id())
-        user_id_str = str(user.get_id())
-
-        if user_id_str in current_user.following:
-            current_user.unfollow(user)
-            user.followers.remove(current_user_id_str)
-            user.update()
 
+        current_user.unfollow(user)
         flash(_('You are not following {}.'.format(username)))
         return redirect(url_for('main.user', username=username))
     else:
@@ -260,8 +218,17 @@ def unfollow(username):
 @login_required
 def user_popup(username):
     user = User.find_by_username(username)
+    if user is None:
+        abort(404)
+
+    etag = user_page_etag(user)
+    response = not_modified(etag) if etag else None
+    if response:
+        return response
+
     form = EmptyForm()
-    return render_template('user_popup.html', user=user, form=form)
+    response = render_template('user_popup.html', user=user, form=form)
+    return conditional(response, etag) if etag else response
 
 
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
@@ -270,37 +237,77 @@ def send_message(recipient):
     user = User.find_by_username(recipient)
     user_id = User.get_id(user)
     form = MessageForm()
-    msg_collection = db.messages
     if form.validate_on_submit():
-        msg_data = {
-            "sender_id": current_user._id,
-            "recipient_id": user_id,
-            "body": form.message.data,
-            "user_name": user.username,
-            "timestamp": datetime.utcnow()
-        }
-        msg_collection.insert_one(msg_data)
+        Message(current_user._id, user_id, form.message.data).save()
         flash(_('Your message has been sent.'))
         return redirect(url_for('main.user', username=recipient))
     return render_template('send_message.html', title=_('Send Message'),form=form, recipient=recipient)
 
 
+@bp.route('/events')
+@login_required
+def events():
+    if not current_app.config['EVENTS_STREAMING']:
+        # 204 tells EventSource to stop reconnecting
+        return '', 204
+
+    user_id = current_user._id
+    unread = current_user.new_messages()
+    heartbeat = current_app.config['EVENTS_HEARTBEAT']
+    max_age = current_app.config['EVENTS_MAX_AGE']
+
+    def event(name, data):
+        return 'event: {}\ndata: {}\n\n'.format(name, json.dumps(data))
+
+    def stream():
+        subscription = notification_pubsub.subscribe(user_id)
+        try:
+            yield 'retry: 5000\n\n'
+            yield event('unread_message_count', unread)
+            # streams end after max_age so a worker is never held forever, the browser reconnects
+            deadline = monotonic() + max_age
+            while monotonic() < deadline:
+                try:
+                    name, data = subscription.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                yield event(name, data)
+        finally:
+            notification_pubsub.unsubscribe(user_id, subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@bp.route('/notifications')
+@login_required
+def notifications():
+    since = request.args.get('since', 0.0, type=float)
+    # MongoDB keeps milliseconds, rounding stops float error from replaying the last notification
+    since = datetime(1970, 1, 1) + timedelta(milliseconds=round(since * 1000))
+    changed = Notification.find_since(current_user._id, since)
+    return jsonify([notification.to_dict() for notification in changed])
+
+
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
+    current_user.mark_messages_read()
 
-    page = request.args.get('page', 1, type=int)
-    per_page = current_app.config['POSTS_PER_PAGE']
+    def fetch(cursor, newer, limit):
+        query = {'recipient_id': current_user._id}
+        query.update(keyset_match(cursor, newer))
+        return db.messages.find(query).sort(keyset_sort(newer)).limit(limit)
 
-    messages = db.messages.find(
-        {'recipient_id': current_user._id}
-    ).sort('timestamp', pymongo.DESCENDING).skip((page - 1) * per_page).limit(per_page)
+    page = paginate(fetch, current_app.config['POSTS_PER_PAGE'],
+                    before=request.args.get('before'), after=request.args.get('after'))
 
-    total_messages = db.messages.count_documents({'recipient_id': current_user._id})
-    total_pages = (total_messages - 1) // per_page + 1
+    senders = User.get_summaries([msg['sender_id'] for msg in page.items])
+    for msg in page.items:
+        msg['sender'] = senders.get(msg['sender_id'])
 
-    next_url = url_for('main.messages', page=page + 1) if page < total_pages else None
-    prev_url = url_for('main.messages', page=page - 1) if page > 1 else None
+    next_url = url_for('main.messages', before=page.next_cursor) if page.next_cursor else None
+    prev_url = url_for('main.messages', after=page.prev_cursor) if page.prev_cursor else None
 
-    return render_template('messages.html', messages=messages, next_url=next_url, prev_url=prev_url)
\ No newline at end of file
+    return render_template('messages.html', messages=page.items, next_url=next_url, prev_url=prev_url)
\ No newline at end of file
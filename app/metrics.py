@@ -0,0 +1,190 @@
+import threading
+from time import perf_counter
+from flask import Response, request
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, name, description, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=''):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for label_value, (counts, total, count) in sorted(self._series.items()):
+                labels = '{}="{}",'.format(self.label, label_value) if self.label else ''
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(self.name, labels, bound, bucket_count))
+                lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(self.name, labels, count))
+                labels = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+                lines.append('{}_sum{} {}'.format(self.name, labels, total))
+                lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, description, kind='counter'):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} {}'.format(self.name, self.kind),
+                '{} {}'.format(self.name, self.value)]
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest = None
+        self.slowest_time = 0.0
+
+
+class Metrics(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+    """Counts MongoDB commands per request and exports Prometheus metrics.
+
+    pymongo calls the listeners on the thread that runs the command, so the
+    stats of the request being served on that thread live in a thread local.
+    Every worker process keeps and exports its own numbers.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self.requests = Histogram('microblog_request_duration_seconds', 'Request latency by endpoint.', 'endpoint')
+        self.request_db_time = Histogram('microblog_request_db_seconds',
+                                         'Time spent in MongoDB commands per request.', 'endpoint')
+        self.request_queries = Histogram('microblog_request_queries', 'MongoDB commands per request.', 'endpoint',
+                                         QUERY_BUCKETS)
+        self.commands = Histogram('microblog_mongo_command_duration_seconds', 'MongoDB command latency.', 'command')
+        self.command_failures = Histogram('microblog_mongo_command_failure_duration_seconds',
+                                          'Latency of failed MongoDB commands.', 'command')
+        self.checkout_wait = Histogram('microblog_mongo_pool_checkout_wait_seconds',
+                                       'Time spent waiting for a pooled connection.', None)
+        self.checkout_failures = Counter('microblog_mongo_pool_checkout_failures_total',
+                                         'Connection checkouts that timed out or failed.')
+        self.checked_out = Counter('microblog_mongo_pool_checked_out', 'Connections currently checked out.', 'gauge')
+        self.connections_created = Counter('microblog_mongo_connections_created_total', 'Connections opened.')
+
+    def init_app(self, app, mongo):
+        mongo.add_event_listener(self)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.export)
+
+    def export(self):
+        lines = []
+        for metric in (self.requests, self.request_db_time, self.request_queries, self.commands,
+                       self.command_failures, self.checkout_wait, self.checkout_failures, self.checked_out,
+                       self.connections_created):
+            lines += metric.render()
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    def _before_request(self):
+        self._local.stats = RequestStats()
+        self._local.started = perf_counter()
+
+    def _after_request(self, response):
+        stats = getattr(self._local, 'stats', None)
+        if stats is None:
+            return response
+        elapsed = perf_counter() - self._local.started
+        endpoint = request.endpoint or 'none'
+
+        self.requests.observe(elapsed, endpoint)
+        self.request_db_time.observe(stats.db_time, endpoint)
+        self.request_queries.observe(stats.queries, endpoint)
+
+        timings = ['db;desc="{} queries";dur={:.2f}'.format(stats.queries, stats.db_time * 1000)]
+        if stats.slowest:
+            timings.append('db-slowest;desc="{}";dur={:.2f}'.format(stats.slowest, stats.slowest_time * 1000))
+        timings.append('app;dur={:.2f}'.format(elapsed * 1000))
+        response.headers.add('Server-Timing', ', '.join(timings))
+        return response
+
+    def _teardown_request(self, exc):
+        self._local.stats = None
+
+    def _record(self, event, histogram):
+        duration = event.duration_micros / 1e6
+        histogram.observe(duration, event.command_name)
+        stats = getattr(self._local, 'stats', None)
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += duration
+            if duration >= stats.slowest_time:
+                stats.slowest = event.command_name
+                stats.slowest_time = duration
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, self.commands)
+
+    def failed(self, event):
+        self._record(event, self.command_failures)
+
+    def connection_check_out_started(self, event):
+        self._local.checkout_started = perf_counter()
+
+    def connection_checked_out(self, event):
+        self.checked_out.inc()
+        started = getattr(self._local, 'checkout_started', None)
+        if started is not None:
+            self.checkout_wait.observe(perf_counter() - started)
+            self._local.checkout_started = None
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures.inc()
+        self._local.checkout_started = None
+
+    def connection_checked_in(self, event):
+        self.checked_out.inc(-1)
+
+    def connection_created(self, event):
+        self.connections_created.inc()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
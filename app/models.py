@@ -1,14 +1,23 @@
 import base64
+import itertools
 import math
 import os
 import jwt
 import json
-from time import time
-from hashlib import md5
+from time import monotonic, time
+from hashlib import md5, sha256
+from bson import ObjectId
 from app import db, login
+from app.cache import TTLCache
+from app.lastseen import LastSeenBuffer
+from app.pagination import keyset_match, keyset_sort
+from app.pubsub import PubSub
+from app.search import add_to_index
 from datetime import datetime, timedelta
 from flask_login import UserMixin
-from flask import current_app, url_for
+from flask import current_app, url_for, g, has_request_context
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -16,17 +25,124 @@ user_collection = db.users
 post_collection = db.posts
 noti_collection = db.notifications
 mess_collection = db.messages
+timeline_collection = db.timelines
+follow_collection = db.follows
+checkpoint_collection = db.checkpoints
+
+AUTHOR_FIELDS = {'username': 1, 'avatar_uri': 1}
+SUMMARY_FIELDS = {'username': 1, 'avatar_uri': 1, 'about_me': 1, 'email': 1}
+
+# per-worker cache of the user fields shown next to posts and messages
+user_summaries = TTLCache()
+
+# per-worker cache of verified API tokens, keyed by token hash. A revoke only clears the worker that
+# served it, so entries older than TOKEN_CACHE_RECHECK seconds confirm the hash is still stored
+token_cache = TTLCache(ttl=30)
+
+last_seen_buffer = LastSeenBuffer(user_collection)
+notification_pubsub = PubSub(noti_collection)
+
+
+def feed_pipeline(match=None, sort=None, limit=None, author_field='user_id'):
+    pipeline = []
+    if match:
+        pipeline.append({'$match': match})
+    if sort:
+        pipeline.append({'$sort': sort})
+    if limit:
+        pipeline.append({'$limit': limit})
+
+    # join after limiting, and only the author fields the templates render
+    pipeline += [
+        {
+            '$lookup': {
+                'from': 'users',
+                'let': {'author_id': '$' + author_field},
+                'pipeline': [
+                    {'$match': {'$expr': {'$eq': ['$_id', '$$author_id']}}},
+                    {'$project': AUTHOR_FIELDS}
+                ],
+                'as': 'user'
+            }
+        },
+        {
+            '$unwind': '$user'
+        }
+    ]
+    return pipeline
+
+
+def hash_token(token):
+    return sha256(token.encode('utf-8')).hexdigest()
+
+
+def gravatar_uri(email, size):
+    digest = md5(email.lower().encode('utf-8')).hexdigest()
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+
+
+def recount_follows(user_ids=None, batch_size=1000):
+    """Reset follower/following counters from the follows collection.
+
+    Covers every user when ``user_ids`` is None.
+    """
+    users = {} if user_ids is None else {'_id': {'$in': list(user_ids)}}
+    for field, counter in (('follower', 'following_count'), ('followee', 'followers_count')):
+        user_collection.update_many(users, {'$set': {counter: 0}})
+        pipeline = [{'$group': {'_id': '$' + field, 'count': {'$sum': 1}}}]
+        if user_ids is not None:
+            pipeline.insert(0, {'$match': {field: {'$in': list(user_ids)}}})
+        requests = []
+        for row in follow_collection.aggregate(pipeline):
+            requests.append(UpdateOne({'_id': row['_id']}, {'$set': {counter: row['count']}}))
+            if len(requests) >= batch_size:
+                user_collection.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            user_collection.bulk_write(requests, ordered=False)
+
+
+def recount_unread(user_ids):
+    for user_data in user_collection.find({'_id': {'$in': list(user_ids)}}, {'last_message_read_time': 1}):
+        query = {'recipient_id': user_data['_id']}
+        if user_data.get('last_message_read_time'):
+            query['timestamp'] = {'$gt': user_data['last_message_read_time']}
+        user_collection.update_one({'_id': user_data['_id']},
+                                   {'$set': {'unread_messages': mess_collection.count_documents(query)}})
+
+
+def run_atomic(callback):
+    # transactions need a replica set or sharded cluster. A standalone server runs the callback as is, so
+    # a failure halfway leaves earlier writes in place and counters are only eventually consistent there,
+    # until recount_follows/recount_unread put them back in step
+    client = db.client
+    if client.topology_description.topology_type_name in ('ReplicaSetWithPrimary', 'Sharded'):
+        with client.start_session() as session:
+            return session.with_transaction(callback)
+    return callback(None)
+
+
+def _identity_map():
+    if not has_request_context():
+        return None
+    if 'identity_map' not in g:
+        g.identity_map = {}
+    return g.identity_map
 
 
 @login.user_loader
 def load_user(user_id):
-    user_data = user_collection.find_one({'_id': user_id})
-    if user_data:
-        return User(user_data)
-    return None
+    return User.find_by_id(user_id)
 
 
 class User(UserMixin):
+    API_FIELDS = ('_id', 'username', 'last_seen', 'about_me', 'followers_count', 'following_count',
+                  'avatar_uri', 'last_message_read_time', 'email')
+
+    # maintained by $inc/$max updates, never rewritten from a possibly stale object
+    MANAGED_FIELDS = ('followers_count', 'following_count', 'unread_messages', 'last_seen',
+                      'token_hash', 'token_expiration')
+
     def __init__(self, user_data):
         self._id = str(user_data['_id'])
         self.username = user_data['username']
@@ -34,35 +150,66 @@ class User(UserMixin):
         self.password_hash = user_data['password_hash']
         self.about_me = user_data.get('about_me', '')
         self.last_seen = user_data.get('last_seen')
-        self.followers = user_data.get("followers", [])
-        self.following = user_data.get("following", [])
-        self.avatar_uri= user_data.get('avatar', self.avatar(36))
-        self.last_message_read_time = user_data.get(datetime(1900, 1, 1))
-        self.token = user_data.get('token', '')
-        self.token_expiration = user_data.get('token_expiration', '')
+        self.followers_count = user_data.get('followers_count', 0)
+        self.following_count = user_data.get('following_count', 0)
+        self.avatar_uri = user_data.get('avatar_uri') or user_data.get('avatar') or self.avatar(36)
+        self.last_message_read_time = user_data.get('last_message_read_time')
+        self.unread_messages = user_data.get('unread_messages', 0)
+        self.token_hash = user_data.get('token_hash')
+        self.token_expiration = user_data.get('token_expiration') or datetime(1970, 1, 1)
+        self.updated_at = user_data.get('updated_at')
 
     def get_token(self, expires_in=3600):
-        now = datetime.utcnow()
-        if self.token and self.token_expiration > now + timedelta(seconds=60):
-            return self.token
-        self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
-        self.token_expiration = now + timedelta(seconds=expires_in)
-        user = User.find_by_username(self.username)
-        
-        return self.token
+        # only a hash is stored, so a fresh token is issued every time
+        token = base64.b64encode(os.urandom(24)).decode('utf-8')
+        previous_hash = self.token_hash
+        self.token_hash = hash_token(token)
+        self.token_expiration = datetime.utcnow() + timedelta(seconds=expires_in)
+        user_collection.update_one(
+            {'_id': self._id},
+            {'$set': {'token_hash': self.token_hash, 'token_expiration': self.token_expiration}, '$unset': {'token': ''}}
+        )
+        if previous_hash:
+            token_cache.delete(previous_hash)
+        return token
 
     def revoke_token(self):
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
+        user_collection.update_one(
+            {'_id': self._id},
+            {'$set': {'token_expiration': self.token_expiration}, '$unset': {'token_hash': '', 'token': ''}}
+        )
+        if self.token_hash:
+            token_cache.delete(self.token_hash)
+        self.token_hash = None
 
     @staticmethod
     def check_token(token):
-        user = User.find_by_token(token)
-        if user is None or user.token_expiration < datetime.utcnow():
+        token_hash = hash_token(token)
+        user_data, checked_at = token_cache.get(token_hash, (None, None))
+        if user_data is not None and monotonic() - checked_at > current_app.config['TOKEN_CACHE_RECHECK']:
+            current = user_collection.find_one({'_id': user_data['_id'], 'token_hash': token_hash},
+                                               {'token_expiration': 1})
+            if current is None:
+                token_cache.delete(token_hash)
+                return None
+            user_data = dict(user_data, token_expiration=current.get('token_expiration'))
+            token_cache.set(token_hash, (user_data, monotonic()))
+        if user_data is None:
+            user_data = user_collection.find_one({'token_hash': token_hash})
+            if user_data is None:
+                return None
+            token_cache.set(token_hash, (user_data, monotonic()))
+
+        user = User(user_data)
+        if user.token_expiration < datetime.utcnow():
+            token_cache.delete(token_hash)
             return None
         return user
 
+    @staticmethod
     def find_by_token(token):
-        user_data = user_collection.find_one({'token': token})
+        user_data = user_collection.find_one({'token_hash': hash_token(token)})
 
         if user_data:
             return User(user_data)
@@ -72,21 +219,74 @@ class User(UserMixin):
         return self._id
 
     def save(self):
+        self.updated_at = datetime.utcnow()
         user_collection.insert_one(self.__dict__).inserted_id
 
     def update_2rgs(self, update_values):
         user_collection.update_one({"_id": self._id}, {'$set': update_values})
 
     def update(self):
-        user_collection.update_one({"_id": self._id},{'$set': self.__dict__})
+        self.updated_at = datetime.utcnow()
+        data = {key: value for key, value in self.__dict__.items() if key not in User.MANAGED_FIELDS}
+        user_collection.update_one({"_id": self._id},{'$set': data})
+
+    @staticmethod
+    def touch(user_id):
+        # bumps the version stamp used for ETag/Last-Modified validators
+        user_collection.update_one({'_id': user_id}, {'$set': {'updated_at': datetime.utcnow()}})
+
+    @staticmethod
+    def find_by_id(user_id):
+        return User._find('_id', user_id)
 
     @staticmethod
     def find_by_username(username):
-        user_data = user_collection.find_one({'username': username})
+        return User._find('username', username)
 
-        if user_data:
-            return User(user_data)
-        return None
+    @staticmethod
+    def _find(field, value):
+        identity_map = _identity_map()
+        if identity_map is not None and (field, value) in identity_map:
+            return identity_map[(field, value)]
+
+        user_data = user_collection.find_one({field: value})
+        user = User(user_data) if user_data else None
+
+        if identity_map is not None and user is not None:
+            identity_map[('_id', user._id)] = user
+            identity_map[('username', user.username)] = user
+        return user
+
+    @staticmethod
+    def invalidate(user):
+        identity_map = _identity_map()
+        if identity_map is not None:
+            for key in [key for key, value in identity_map.items() if value is user]:
+                del identity_map[key]
+            identity_map[('_id', user._id)] = user
+            identity_map[('username', user.username)] = user
+        user_summaries.delete(user._id)
+
+    @staticmethod
+    def get_summaries(user_ids):
+        summaries = {}
+        missing = []
+        for user_id in set(user_ids):
+            summary = user_summaries.get(user_id)
+            if summary is None:
+                missing.append(user_id)
+            else:
+                summaries[user_id] = summary
+
+        if missing:
+            for user_data in user_collection.find({'_id': {'$in': missing}}, SUMMARY_FIELDS):
+                email = user_data.pop('email', '')
+                if 'avatar_uri' not in user_data:
+                    user_data['avatar_uri'] = gravatar_uri(email, 36)
+                user_data.setdefault('about_me', '')
+                user_summaries.set(user_data['_id'], user_data)
+                summaries[user_data['_id']] = user_data
+        return summaries
     
     @staticmethod
     def find_by_email(email):
@@ -103,24 +303,63 @@ class User(UserMixin):
         return check_password_hash(self.password_hash, password)
     
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+        return gravatar_uri(self.email, size)
     
     def is_following(self, user_id):
-        return str(user_id) in self.following
+        return follow_collection.find_one({'follower': self._id, 'followee': str(user_id)}, {'_id': 1}) is not None
     
     def follow(self, user):
-        if user._id != self._id and user._id not in self.following:
-            self.following.append(user._id)
-            self.update_2rgs({"following": self.following})
+        if user._id == self._id:
+            return None
+
+        def apply(session):
+            result = follow_collection.update_one(
+                {'follower': self._id, 'followee': user._id},
+                {'$setOnInsert': {'timestamp': datetime.utcnow()}},
+                upsert=True,
+                session=session
+            )
+            if result.upserted_id is None:
+                return None
+            return self._change_follow_counts(user, 1, session)
+
+        counts = run_atomic(apply)
+        if counts is not None:
+            Timeline.add_author(self, user)
+        return counts
 
     def unfollow(self, user):
-        if user._id != self._id and user._id in self.following:
-            self.following.remove(user._id)
-            self.update_2rgs({"following": self.following})
+        def apply(session):
+            result = follow_collection.delete_one({'follower': self._id, 'followee': user._id}, session=session)
+            if result.deleted_count == 0:
+                return None
+            return self._change_follow_counts(user, -1, session)
+
+        counts = run_atomic(apply)
+        if counts is not None:
+            Timeline.remove_author(self, user)
+        return counts
+
+    def _change_follow_counts(self, user, delta, session):
+        now = datetime.utcnow()
+        user_collection.bulk_write([
+            UpdateOne({'_id': user._id}, {'$inc': {'followers_count': delta}, '$set': {'updated_at': now}}),
+            UpdateOne({'_id': self._id}, {'$inc': {'following_count': delta}, '$set': {'updated_at': now}}),
+        ], ordered=False, session=session)
+        counts = {user_data['_id']: user_data for user_data in user_collection.find(
+            {'_id': {'$in': [user._id, self._id]}}, {'followers_count': 1, 'following_count': 1}, session=session)}
+        user.followers_count = counts[user._id].get('followers_count', 0)
+        self.following_count = counts[self._id].get('following_count', 0)
+        return {'followers_count': user.followers_count, 'following_count': self.following_count}
+
+    def follower_ids(self):
+        return (edge['follower'] for edge in follow_collection.find({'followee': self._id}, {'follower': 1}))
+
+    def following_ids(self):
+        return (edge['followee'] for edge in follow_collection.find({'follower': self._id}, {'followee': 1}))
     
     def followed_posts(self):
-        followed_ids = self.following
+        followed_ids = list(self.following_ids())
         
         followed_ids.append(self._id)
         
@@ -137,38 +376,54 @@ class User(UserMixin):
         )
     
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return db.messages.count_documents({
-            'recipient_id': self._id,
-            'timestamp': {'$gt': last_read_time}
-        })
+        return self.unread_messages
+
+    def mark_messages_read(self):
+        had_unread = bool(self.unread_messages)
+        self.last_message_read_time = datetime.utcnow()
+        self.unread_messages = 0
+        # last_message_read_time is part of the API representation, so bump the validator too
+        self.updated_at = self.last_message_read_time
+        user_collection.update_one(
+            {'_id': self._id},
+            {'$set': {'last_message_read_time': self.last_message_read_time, 'unread_messages': 0,
+                      'updated_at': self.updated_at}}
+        )
+        if had_unread:
+            self.add_notification('unread_message_count', 0)
     
     def add_notification(self, name, data):
-        noti_collection.delete_many({"user_id": self._id, "name": name})
+        return Notification.add(self._id, name, data)
 
-        notification = {
-            "name": name,
-            "payload_json": json.dumps(data),
-            "user_id": self._id
-        }
-
-        noti_collection.insert_one(notification)
+    def to_dict(self, include_email=False, fields=None):
+        return User.dict_from_data(self.__dict__, include_email, fields)
 
-        return notification
-
-    def to_dict(self, include_email=False):
-        data = {
-            '_id': self._id,
-            'username': self.username,
-            'last_seen': self.last_seen or datetime.utcnow(),
-            'about_me': self.about_me,
-            'followers': self.followers,
-            'following': self.following,
-            'avatar_uri': self.avatar_uri,
-            'last_message_read_time': self.last_message_read_time or datetime.utcnow(),
-            'email': self.email if include_email else None
-        }
+    @staticmethod
+    def dict_from_data(user_data, include_email=False, fields=None):
+        # works on raw documents too, so API listings never build User objects
+        data = {}
+        for field in fields or User.API_FIELDS:
+            if field == '_id':
+                value = str(user_data['_id'])
+            elif field == 'email':
+                value = user_data.get('email') if include_email else None
+            elif field == 'avatar_uri':
+                value = user_data.get('avatar_uri') or gravatar_uri(user_data.get('email', ''), 36)
+            elif field in ('last_seen', 'last_message_read_time'):
+                value = user_data.get(field) or datetime.utcnow()
+            elif field in ('followers_count', 'following_count'):
+                value = user_data.get(field, 0)
+            else:
+                value = user_data.get(field, '')
+            data[field] = value
         return data
+
+    @staticmethod
+    def api_projection(fields):
+        projection = {field: 1 for field in fields}
+        if 'avatar_uri' in fields:
+            projection['email'] = 1
+        return projection
     
     def from_dict(self, data, new_user=False):
         for field in ['username', 'email', 'about_me']:
@@ -191,6 +446,8 @@ class User(UserMixin):
     
 
 class Post:
+    __searchable__ = ['body']
+
     def __init__(self, body, user_id):
         self.body = body
         self.timestamp = datetime.utcnow()
@@ -207,23 +464,48 @@ class Post:
 
     @staticmethod
     def find_all_with_user_info():
-        pipeline = [
-            {
-                "$lookup": {
-                    "from": "users",
-                    "localField": "user_id",
-                    "foreignField": "_id",
-                    "as": "user"
-                }
-            },
-            {
-                "$unwind": "$user"
-            }
-        ]
+        return post_collection.aggregate(feed_pipeline())
+
+    @staticmethod
+    def publish(author, documents):
+        """Insert posts by ``author`` and run the side effects once for the batch.
+
+        Returns ``{position: error}`` for documents that were not written.
+        """
+        failed = {}
+        if not documents:
+            return failed
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+        try:
+            post_collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                failed[error['index']] = error['errmsg']
+
+        inserted = [document for position, document in enumerate(documents) if position not in failed]
+        if inserted:
+            Timeline.push_many([(document['_id'], document['timestamp']) for document in inserted], author)
+            try:
+                add_to_index('posts', [Post.search_document(document) for document in inserted])
+            except Exception:
+                # the posts are stored, 'flask search reindex' picks up what the index missed
+                current_app.logger.exception('Indexing %d posts failed', len(inserted))
+            User.touch(author._id)
+        return failed
 
-        posts = post_collection.aggregate(pipeline)
+    @staticmethod
+    def search_document(post_data):
+        document = {field: post_data[field] for field in Post.__searchable__}
+        document['_id'] = post_data['_id']
+        document['timestamp'] = post_data['timestamp']
+        return document
 
-        return posts
+    @staticmethod
+    def fetch_feed(match, cursor, newer, limit):
+        query = dict(match)
+        query.update(keyset_match(cursor, newer))
+        return post_collection.aggregate(feed_pipeline(query, dict(keyset_sort(newer)), limit))
     
     @staticmethod
     def find_by_user_id(user_id):
@@ -246,14 +528,22 @@ class Message:
         }
         result = mess_collection.insert_one(mess_data)
         self.id = result.inserted_id 
+        recipient = user_collection.find_one_and_update(
+            {'_id': self.recipient_id},
+            {'$inc': {'unread_messages': 1}},
+            projection={'unread_messages': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if recipient is not None:
+            Notification.add(self.recipient_id, 'unread_message_count', recipient['unread_messages'])
     
     @staticmethod
     def find_by_sender(sender_id):
-        return list(db.messages.find({'sender_id': sender_id}))
+        return mess_collection.find({'sender_id': sender_id})
 
     @staticmethod
     def find_by_recipient(recipient_id):
-        return list(db.messages.find({'recipient_id': recipient_id}))
+        return mess_collection.find({'recipient_id': recipient_id})
 
     def __repr__(self):
         return f"<Message sender_id={self.sender_id}, recipient_id={self.recipient_id}, body='{self.body}'>"
@@ -263,38 +553,165 @@ class Notification:
     def __init__(self, name, user_id, timestamp, payload_json):
         self.name = name
         self.user_id = user_id
-        self.timestamp = datetime.utcnow()
+        self.timestamp = timestamp or datetime.utcnow()
         self.payload_json = payload_json
 
     def get_data(self):
         return json.loads(str(self.payload_json))
 
     def save(self):
-        noti_data = {
-            "name": self.name,
-            "user_id": self.user_id,
-            "timestamp": self.timestamp,
-            "payload_json": self.payload_json
-        }   
-        result = noti_collection.insert_one(noti_data)
-        self.id = result.inserted_id 
+        # one document per (user_id, name), overwritten in place
+        noti_data = noti_collection.find_one_and_update(
+            {"user_id": self.user_id, "name": self.name},
+            {"$set": {"timestamp": self.timestamp, "payload_json": self.payload_json}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self.id = noti_data['_id']
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'data': self.get_data(),
+            'timestamp': (self.timestamp - datetime(1970, 1, 1)).total_seconds()
+        }
+
+    @staticmethod
+    def add(user_id, name, data):
+        notification = Notification(name, user_id, datetime.utcnow(), json.dumps(data))
+        notification.save()
+        notification_pubsub.publish(user_id, name, data)
+        return notification
+
+    @staticmethod
+    def find_since(user_id, since):
+        query = {'user_id': user_id, 'timestamp': {'$gt': since}}
+        for noti_data in noti_collection.find(query).sort('timestamp', 1):
+            yield Notification(noti_data['name'], noti_data['user_id'], noti_data['timestamp'],
+                               noti_data['payload_json'])
 
     @staticmethod
     def find_all_with_user_info():
-        pipeline = [
-            {
-                "$lookup": {
-                    "from": "users",
-                    "localField": "user_id",
-                    "foreignField": "_id",
-                    "as": "user"
+        return noti_collection.aggregate(feed_pipeline())
+
+
+class Timeline:
+    @staticmethod
+    def push(post_id, timestamp, author):
+        Timeline.push_many([(post_id, timestamp)], author)
+
+    @staticmethod
+    def push_many(posts, author):
+        entries = [{'_id': post_id, 'timestamp': timestamp, 'user_id': author._id} for post_id, timestamp in posts]
+        recipients = [author._id]
+
+        if author.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT']:
+            # too many followers to fan out, their followers pull these posts on read
+            user_collection.update_one({'_id': author._id}, {'$set': {'pull_on_read': True}})
+        else:
+            recipients = itertools.chain(recipients, author.follower_ids())
+
+        update = Timeline._merge(entries)
+        requests = []
+        for user_id in recipients:
+            requests.append(UpdateOne({'_id': user_id}, update, upsert=True))
+            if len(requests) == 1000:
+                timeline_collection.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            timeline_collection.bulk_write(requests, ordered=False)
+
+    @staticmethod
+    def _merge(entries):
+        return {
+            '$push': {
+                'posts': {
+                    '$each': entries,
+                    '$sort': {'timestamp': -1, '_id': -1},
+                    '$slice': current_app.config['TIMELINE_LENGTH']
                 }
-            },
-            {
-                "$unwind": "$user"
             }
+        }
+
+    @staticmethod
+    def add_author(user, author):
+        entries = list(post_collection.find(
+            {'user_id': author._id}, {'timestamp': 1, 'user_id': 1}
+        ).sort([('timestamp', -1), ('_id', -1)]).limit(current_app.config['TIMELINE_LENGTH']))
+        if entries:
+            timeline_collection.update_one({'_id': user._id}, Timeline._merge(entries), upsert=True)
+
+    @staticmethod
+    def remove_author(user, author):
+        timeline_collection.update_one({'_id': user._id}, {'$pull': {'posts': {'user_id': author._id}}})
+
+    @staticmethod
+    def pulled_authors(user):
+        authors = [author['_id'] for author in user_collection.find({'pull_on_read': True}, {'_id': 1})]
+        authors = [author_id for author_id in authors if author_id != user._id]
+        if not authors:
+            return []
+        return [
+            edge['followee']
+            for edge in follow_collection.find({'follower': user._id, 'followee': {'$in': authors}}, {'followee': 1})
         ]
 
-        notis = noti_collection.aggregate(pipeline)
+    @staticmethod
+    def rebuild(user):
+        pulled = Timeline.pulled_authors(user)
+        followed_ids = [user._id] + [user_id for user_id in user.following_ids() if user_id not in pulled]
+        entries = list(post_collection.find(
+            {'user_id': {'$in': followed_ids}}, {'timestamp': 1, 'user_id': 1}
+        ).sort([('timestamp', -1), ('_id', -1)]).limit(current_app.config['TIMELINE_LENGTH']))
+
+        timeline_collection.update_one({'_id': user._id}, {'$set': {'posts': entries}}, upsert=True)
 
-        return notis
\ No newline at end of file
+    @staticmethod
+    def fetch(user, cursor, newer, limit):
+        if cursor is None:
+            timeline = timeline_collection.find_one({'_id': user._id}, {'posts': {'$slice': limit}})
+        else:
+            timestamp, _id = cursor
+            op = '$gt' if newer else '$lt'
+            window = {
+                '$filter': {
+                    'input': '$posts',
+                    'as': 'post',
+                    'cond': {
+                        '$or': [
+                            {op: ['$$post.timestamp', timestamp]},
+                            {'$and': [{'$eq': ['$$post.timestamp', timestamp]}, {op: ['$$post._id', _id]}]}
+                        ]
+                    }
+                }
+            }
+            pipeline = [
+                {'$match': {'_id': user._id}},
+                {'$project': {'posts': {'$slice': [window, -limit if newer else limit]}}}
+            ]
+            timeline = next(timeline_collection.aggregate(pipeline), None)
+
+        entries = timeline['posts'] if timeline else []
+        if newer:
+            entries.reverse()
+
+        pulled = Timeline.pulled_authors(user)
+        if pulled:
+            query = {'user_id': {'$in': pulled}}
+            query.update(keyset_match(cursor, newer))
+            entries += post_collection.find(query, {'timestamp': 1}).sort(keyset_sort(newer)).limit(limit)
+
+            merged = {}
+            for entry in entries:
+                merged[entry['_id']] = entry
+            entries = sorted(merged.values(), key=lambda e: (e['timestamp'], e['_id']), reverse=not newer)
+            entries = entries[:limit]
+
+        if not entries:
+            return []
+
+        pipeline = feed_pipeline(
+            match={'_id': {'$in': [entry['_id'] for entry in entries]}},
+            sort=dict(keyset_sort(newer))
+        )
+        return list(post_collection.aggregate(pipeline))
\ No newline at end of file
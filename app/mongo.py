@@ -0,0 +1,121 @@
+import os
+import threading
+from pymongo import MongoClient
+from pymongo.database import Database
+
+
+class Mongo:
+    """Creates the MongoClient on first use, once per process.
+
+    A client opened before gunicorn forks shares its sockets and monitor
+    threads with every worker, so each process builds its own and the
+    import and boot path never talks to the server.
+    """
+
+    def __init__(self, app=None):
+        self.uri = os.environ.get('MONGODB_URI') or 'mongodb://localhost:27017/microblog'
+        self.options = {}
+        self.event_listeners = []
+        self.database = LazyDatabase(self)
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        options = {
+            'maxPoolSize': app.config['MONGO_MAX_POOL_SIZE'],
+            'minPoolSize': app.config['MONGO_MIN_POOL_SIZE'],
+            'maxIdleTimeMS': app.config['MONGO_MAX_IDLE_TIME_MS'],
+            'connectTimeoutMS': app.config['MONGO_CONNECT_TIMEOUT_MS'],
+            'socketTimeoutMS': app.config['MONGO_SOCKET_TIMEOUT_MS'],
+            'serverSelectionTimeoutMS': app.config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+            'waitQueueTimeoutMS': app.config['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+            'compressors': app.config['MONGO_COMPRESSORS'],
+        }
+        with self._lock:
+            self.uri = app.config['MONGO_URI']
+            self.options = {key: value for key, value in options.items() if value}
+            self._reset()
+        app.extensions['mongo'] = self
+
+    def add_event_listener(self, listener):
+        # listeners are fixed when the client is built, so the next use builds a new one
+        with self._lock:
+            if listener not in self.event_listeners:
+                self.event_listeners.append(listener)
+                self._reset()
+
+    @property
+    def client(self):
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                # the parent's client is unusable after a fork, abandon it without closing
+                self._client = MongoClient(self.uri, event_listeners=self.event_listeners, **self.options)
+                self._pid = os.getpid()
+            return self._client
+
+    @property
+    def db(self):
+        return self.client.get_default_database('microblog')
+
+    def close(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        if self._client is not None and self._pid == os.getpid():
+            self._client.close()
+        self._client = None
+        self._pid = None
+
+
+class LazyDatabase:
+    """Stands in for the Database so ``db.users`` works at import time."""
+
+    def __init__(self, mongo):
+        self._mongo = mongo
+        self._collections = {}
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections.setdefault(name, LazyCollection(self._mongo, name))
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if hasattr(Database, name):
+            return getattr(self._mongo.db, name)
+        return self[name]
+
+
+class LazyCollection:
+    def __init__(self, mongo, name):
+        self._mongo = mongo
+        self._name = name
+        self._client = None
+        self._collection = None
+
+    def _target(self):
+        client = self._mongo.client
+        if self._client is not client:
+            self._collection = client.get_default_database('microblog')[self._name]
+            self._client = client
+        return self._collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._target(), name)
+
+    def __getitem__(self, name):
+        return self._target()[name]
+
+    def __repr__(self):
+        return '<LazyCollection {}>'.format(self._name)
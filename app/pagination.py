@@ -0,0 +1,90 @@
+import base64
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class Page:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def encode_cursor(doc):
+    micros = (doc['timestamp'] - EPOCH) // timedelta(microseconds=1)
+    raw = '{}.{}'.format(micros, doc['_id'])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        micros, _id = raw.split('.')
+        return EPOCH + timedelta(microseconds=int(micros)), ObjectId(_id)
+    except (ValueError, InvalidId):
+        return None
+
+
+def encode_score_cursor(score, _id):
+    raw = '{!r}:{}'.format(float(score), _id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def decode_score_cursor(token):
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        score, _id = raw.split(':')
+        return float(score), ObjectId(_id)
+    except (ValueError, InvalidId):
+        return None
+
+
+def keyset_match(cursor, newer=False):
+    if cursor is None:
+        return {}
+    timestamp, _id = cursor
+    op = '$gt' if newer else '$lt'
+    return {'$or': [{'timestamp': {op: timestamp}}, {'timestamp': timestamp, '_id': {op: _id}}]}
+
+
+def keyset_sort(newer=False):
+    direction = 1 if newer else -1
+    return [('timestamp', direction), ('_id', direction)]
+
+
+def paginate(fetch, per_page, before=None, after=None):
+    """Fetch one page ordered newest first.
+
+    ``fetch(cursor, newer, limit)`` must return up to ``limit`` documents
+    past ``cursor``, ordered away from it (oldest first when ``newer``).
+    """
+    after_cursor = decode_cursor(after)
+
+    if after_cursor is not None:
+        items = list(fetch(after_cursor, True, per_page + 1))
+        has_newer = len(items) > per_page
+        has_older = True
+        items = items[:per_page][::-1]
+    else:
+        before_cursor = decode_cursor(before)
+        items = list(fetch(before_cursor, False, per_page + 1))
+        has_newer = before_cursor is not None
+        has_older = len(items) > per_page
+        items = items[:per_page]
+
+    if not items:
+        return Page(items)
+
+    return Page(
+        items,
+        next_cursor=encode_cursor(items[-1]) if has_older else None,
+        prev_cursor=encode_cursor(items[0]) if has_newer else None
+    )
@@ -0,0 +1,100 @@
+import json
+import logging
+import queue
+import threading
+from time import sleep
+from pymongo.errors import OperationFailure, PyMongoError
+from app.threads import WorkerThreads
+
+
+class PubSub:
+    """Fans notifications out to the event streams open in this process.
+
+    On a replica set the notifications change stream is the source of
+    events, so writes made by any worker reach every subscriber. A
+    standalone server has no change streams and events only reach
+    subscribers in the process that published them.
+    """
+
+    def __init__(self, collection, queue_size=100):
+        self.collection = collection
+        self.queue_size = queue_size
+        self.logger = logging.getLogger(__name__)
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._change_streams = None
+        self._watcher = WorkerThreads(self._watch, 'notification-watcher')
+
+    def init_app(self, app):
+        self.queue_size = app.config['EVENTS_QUEUE_SIZE']
+        self.logger = app.logger
+
+    def subscribe(self, user_id):
+        subscription = queue.Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        if self.uses_change_streams():
+            self._watcher.start()
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[user_id]
+
+    def publish(self, user_id, name, data):
+        if not self.uses_change_streams():
+            self._deliver(user_id, name, data)
+
+    def uses_change_streams(self):
+        if self._change_streams is None:
+            try:
+                with self.collection.watch(max_await_time_ms=1):
+                    pass
+                self._change_streams = True
+            except OperationFailure:
+                self._change_streams = False
+        return self._change_streams
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._subscribers),
+                'streams': sum(len(subscriptions) for subscriptions in self._subscribers.values()),
+                'change_streams': bool(self._change_streams)
+            }
+
+    def _deliver(self, user_id, name, data):
+        with self._lock:
+            subscriptions = list(self._subscribers.get(user_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait((name, data))
+            except queue.Full:
+                # a stalled client only misses counts it will get again on reconnect
+                pass
+
+    def _watch(self):
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+        resume_token = None
+        while True:
+            try:
+                with self.collection.watch(pipeline, full_document='updateLookup',
+                                           resume_after=resume_token) as stream:
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        document = change.get('fullDocument')
+                        if document is not None:
+                            self._deliver(document['user_id'], document['name'],
+                                          json.loads(document['payload_json']))
+            except OperationFailure:
+                # the resume point may have rolled off the oplog
+                self.logger.exception('notification change stream failed, reopening from now')
+                resume_token = None
+                sleep(1)
+            except PyMongoError:
+                self.logger.exception('notification change stream failed, reopening')
+                sleep(1)
@@ -1,31 +1,91 @@
+from bson import ObjectId
 from flask import current_app
-from app import db
-
-
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    print(model)
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-
-    print(index)
-    print(model)
-    print(payload)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
-
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, id=model.id)
-
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+from pymongo import ReplaceOne, TEXT
+
+
+class MongoSearchEngine:
+    """Text index over a search_<index> collection, needs nothing but MongoDB."""
+
+    def __init__(self, database):
+        self.db = database
+        self._ready = set()
+
+    def collection(self, index):
+        collection = self.db['search_' + index]
+        if index not in self._ready:
+            # $text needs the index to exist, every string field is searchable
+            collection.create_index([('$**', TEXT)])
+            self._ready.add(index)
+        return collection
+
+    def add(self, index, documents):
+        requests = [ReplaceOne({'_id': document['_id']}, document, upsert=True) for document in documents]
+        if requests:
+            self.collection(index).bulk_write(requests, ordered=False)
+
+    def remove(self, index, ids):
+        self.collection(index).delete_many({'_id': {'$in': list(ids)}})
+
+    def query(self, index, text, cursor, limit):
+        pipeline = [
+            {'$match': {'$text': {'$search': text}}},
+            {'$addFields': {'score': {'$meta': 'textScore'}}}
+        ]
+        if cursor is not None:
+            score, _id = cursor
+            pipeline.append({'$match': {'$or': [{'score': {'$lt': score}}, {'score': score, '_id': {'$lt': _id}}]}})
+        pipeline += [
+            {'$sort': {'score': -1, '_id': -1}},
+            {'$limit': limit},
+            {'$project': {'score': 1}}
+        ]
+        return [(hit['_id'], hit['score']) for hit in self.collection(index).aggregate(pipeline)]
+
+
+class ElasticsearchEngine:
+    def __init__(self, url):
+        from elasticsearch import Elasticsearch
+        self.es = Elasticsearch(url)
+
+    def add(self, index, documents):
+        from elasticsearch.helpers import bulk
+        actions = []
+        for document in documents:
+            source = {key: value for key, value in document.items() if key != '_id'}
+            source['doc_id'] = str(document['_id'])
+            actions.append({'_index': index, '_id': str(document['_id']), '_source': source})
+        if actions:
+            bulk(self.es, actions)
+
+    def remove(self, index, ids):
+        from elasticsearch.helpers import bulk
+        bulk(self.es, ({'_op_type': 'delete', '_index': index, '_id': str(_id)} for _id in ids), raise_on_error=False)
+
+    def query(self, index, text, cursor, limit):
+        body = {
+            'query': {'multi_match': {'query': text, 'fields': ['*'], 'lenient': True}},
+            'sort': [{'_score': 'desc'}, {'doc_id.keyword': 'desc'}],
+            'size': limit
+        }
+        if cursor is not None:
+            body['search_after'] = [cursor[0], str(cursor[1])]
+        search = self.es.search(index=index, body=body)
+        return [(ObjectId(hit['_id']), hit['_score']) for hit in search['hits']['hits']]
+
+
+def create_engine(app, database):
+    if app.config['SEARCH_ENGINE'] == 'elasticsearch':
+        return ElasticsearchEngine(app.config['ELASTICSEARCH_URL'])
+    return MongoSearchEngine(database)
+
+
+def add_to_index(index, documents):
+    current_app.search_engine.add(index, documents)
+
+
+def remove_from_index(index, ids):
+    current_app.search_engine.remove(index, ids)
+
+
+def query_index(index, text, cursor, limit):
+    return current_app.search_engine.query(index, text, cursor, limit)
@@ -0,0 +1,149 @@
+import logging
+import os
+import queue
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from time import monotonic
+from bson import json_util
+from flask import has_request_context, request
+from pymongo import monitoring
+from app.threads import WorkerThreads
+
+EXPLAINABLE = {'find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify'}
+
+# driver bookkeeping that explain rejects
+SESSION_FIELDS = {'lsid', 'txnNumber', 'autocommit', 'startTransaction', 'readConcern', 'writeConcern'}
+
+# parts of a query plan that repeat the literal values of the query
+PLAN_VALUES = {'parsedQuery', 'filter', 'indexBounds'}
+
+
+def redact(value):
+    """Replace every literal in a command with its type name, keeping field names and operators."""
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [redact(item) for item in value]
+        if all(isinstance(item, str) for item in items):
+            # an $in of a thousand ids has the same shape as an $in of one
+            return sorted(set(items))
+        return items
+    return type(value).__name__
+
+
+def redact_plan(plan):
+    if isinstance(plan, dict):
+        return {key: redact(value) if key in PLAN_VALUES else redact_plan(value) for key, value in plan.items()}
+    if isinstance(plan, list):
+        return [redact_plan(item) for item in plan]
+    return plan
+
+
+class SlowQueryLog(monitoring.CommandListener):
+    """Logs commands slower than a threshold along with their query plan.
+
+    Explains run on a background thread, at most one every
+    ``explain_interval`` seconds and once per query shape per
+    ``shape_ttl`` seconds, so a burst of slow queries cannot turn into a
+    burst of extra load on the server.
+    """
+
+    def __init__(self):
+        self.threshold = 0
+        self.explain_interval = 10
+        self.shape_ttl = 300
+        self.mongo = None
+        self.logger = logging.getLogger('microblog.slow_queries')
+        self.logger.propagate = False
+        self._pending = {}
+        self._queue = queue.Queue(100)
+        self._explained = {}
+        self._last_explain = None
+        self._worker = WorkerThreads(self._work, 'slow-query-log')
+
+    def init_app(self, app, mongo):
+        self.threshold = app.config['SLOW_QUERY_THRESHOLD_MS'] / 1000
+        self.explain_interval = app.config['SLOW_QUERY_EXPLAIN_INTERVAL']
+        self.shape_ttl = app.config['SLOW_QUERY_SHAPE_TTL']
+        self.mongo = mongo
+        if not self.threshold:
+            return
+
+        path = app.config['SLOW_QUERY_LOG']
+        if not any(getattr(handler, 'baseFilename', None) == os.path.abspath(path) for handler in self.logger.handlers):
+            if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            handler = RotatingFileHandler(path, maxBytes=1024 * 1024, backupCount=10, delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+        mongo.add_event_listener(self)
+
+    def started(self, event):
+        if not self.threshold or event.command_name not in EXPLAINABLE:
+            return
+        endpoint = request.endpoint if has_request_context() else None
+        self._pending[(event.connection_id, event.request_id)] = (event.command, endpoint)
+
+    def succeeded(self, event):
+        self._finish(event, None)
+
+    def failed(self, event):
+        self._finish(event, event.failure)
+
+    def _finish(self, event, failure):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None or event.duration_micros < self.threshold * 1e6:
+            return
+        command, endpoint = pending
+        command = {key: value for key, value in command.items()
+                   if key not in SESSION_FIELDS and not key.startswith('$')}
+        shape = redact(command)
+        # the collection name is not user data and says which query this was
+        shape[event.command_name] = command.get(event.command_name)
+        record = {
+            'time': datetime.utcnow(),
+            'duration_ms': event.duration_micros / 1000,
+            'database': event.database_name,
+            'command_name': event.command_name,
+            'endpoint': endpoint,
+            'command': shape,
+            # only sent to explain, never written to the log
+            '_command': command,
+        }
+        if failure is not None:
+            # error messages quote the offending values, duplicate keys for one
+            record['failure'] = {'code': failure.get('code'), 'codeName': failure.get('codeName')}
+        self._worker.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+    def _should_explain(self, record):
+        shape = (record['database'], json_util.dumps(record['command'], sort_keys=True))
+        now = monotonic()
+        if self._last_explain is not None and now - self._last_explain < self.explain_interval:
+            return False
+        if now - self._explained.get(shape, -self.shape_ttl) < self.shape_ttl:
+            return False
+        self._last_explain = now
+        self._explained = {key: value for key, value in self._explained.items() if now - value < self.shape_ttl}
+        self._explained[shape] = now
+        return True
+
+    def _explain(self, record):
+        try:
+            result = self.mongo.client[record['database']].command(
+                {'explain': record['_command'], 'verbosity': 'queryPlanner'})
+            return redact_plan(result.get('queryPlanner', result))
+        except Exception as e:
+            return {'error': str(e)}
+
+    def _work(self):
+        while True:
+            record = self._queue.get()
+            if self._should_explain(record):
+                record['plan'] = self._explain(record)
+            del record['_command']
+            self.logger.info(json_util.dumps(record))
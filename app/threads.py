@@ -0,0 +1,36 @@
+import os
+import threading
+
+
+class WorkerThreads:
+    """Daemon threads running ``target``, started on first use.
+
+    Threads do not survive a fork, so a process that inherited the
+    threads of its parent starts its own.
+    """
+
+    def __init__(self, target, name, count=1):
+        self.target = target
+        self.name = name
+        self.count = count
+        self.threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.threads) if self._pid == os.getpid() else 0
+
+    def start(self):
+        if self.threads and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self.threads and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.threads = [
+                threading.Thread(target=self.target, daemon=True,
+                                 name='{}-{}'.format(self.name, i) if self.count > 1 else self.name)
+                for i in range(self.count)
+            ]
+            for thread in self.threads:
+                thread.start()
@@ -0,0 +1,117 @@
+import bson
+from bson import json_util
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from app.models import user_collection, post_collection, mess_collection, follow_collection, recount_follows, \
+    recount_unread
+
+# tokens are credentials for this deployment only, an imported user signs in again
+PRIVATE_FIELDS = ('token_hash', 'token_expiration', 'token')
+
+COLLECTIONS = {
+    'users': user_collection,
+    'posts': post_collection,
+    'messages': mess_collection,
+    'follows': follow_collection,
+}
+
+
+def user_records(user_id, batch_size):
+    """Yield ``(collection, document)`` for everything that belongs to a user."""
+    user_data = user_collection.find_one({'_id': user_id})
+    if user_data is None:
+        return
+    for field in PRIVATE_FIELDS:
+        user_data.pop(field, None)
+    yield 'users', user_data
+
+    queries = [
+        ('posts', {'user_id': user_id}),
+        ('messages', {'sender_id': user_id}),
+        ('messages', {'recipient_id': user_id}),
+        ('follows', {'follower': user_id}),
+        ('follows', {'followee': user_id}),
+    ]
+    for name, query in queries:
+        for document in COLLECTIONS[name].find(query).sort('_id', 1).batch_size(batch_size):
+            yield name, document
+
+
+def write_records(records, stream, format):
+    for name, document in records:
+        record = {'collection': name, 'document': document}
+        if format == 'bson':
+            stream.write(bson.encode(record))
+        else:
+            stream.write((json_util.dumps(record) + '\n').encode('utf-8'))
+        yield name
+
+
+def read_records(stream, format):
+    if format == 'bson':
+        for record in bson.decode_file_iter(stream):
+            yield record['collection'], record['document']
+    else:
+        for line in stream:
+            if line.strip():
+                record = json_util.loads(line)
+                yield record['collection'], record['document']
+
+
+def upsert(name, document):
+    if name == 'follows':
+        # edges are unique on the pair, not on _id, so the pair is the key
+        edge = {'follower': document['follower'], 'followee': document['followee']}
+        fields = {key: value for key, value in document.items() if key not in ('_id', 'follower', 'followee')}
+        return UpdateOne(edge, {'$setOnInsert': fields}, upsert=True)
+    return ReplaceOne({'_id': document['_id']}, document, upsert=True)
+
+
+class Importer:
+    """Buffers upserts per collection and writes them in unordered chunks."""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.pending = {name: [] for name in COLLECTIONS}
+        self.written = 0
+        self.errors = []
+        # users whose counters may no longer match the edges and messages
+        self.follow_users = set()
+        self.message_users = set()
+
+    def add(self, name, document):
+        if name not in COLLECTIONS:
+            raise ValueError('unknown collection {!r}'.format(name))
+        self.pending[name].append(upsert(name, document))
+        if name == 'follows':
+            self.follow_users.update((document['follower'], document['followee']))
+        elif name == 'messages':
+            self.message_users.add(document['recipient_id'])
+        elif name == 'users':
+            # the imported document carries the source database's counters
+            self.follow_users.add(document['_id'])
+            self.message_users.add(document['_id'])
+        if len(self.pending[name]) >= self.batch_size:
+            self.flush(name)
+
+    def flush(self, name=None):
+        for name in [name] if name else list(self.pending):
+            requests, self.pending[name] = self.pending[name], []
+            if not requests:
+                continue
+            failed = []
+            try:
+                COLLECTIONS[name].bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                failed = [(name, error['errmsg']) for error in e.details['writeErrors']]
+                self.errors += failed
+            self.written += len(requests) - len(failed)
+
+    def recount(self):
+        """Recompute counters for every user the import touched, after the final flush."""
+        follow_users, self.follow_users = list(self.follow_users), set()
+        message_users, self.message_users = list(self.message_users), set()
+        for start in range(0, len(follow_users), self.batch_size):
+            recount_follows(follow_users[start:start + self.batch_size], self.batch_size)
+        for start in range(0, len(message_users), self.batch_size):
+            recount_unread(message_users[start:start + self.batch_size])
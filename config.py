@@ -3,6 +3,18 @@ import os
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     MONGO_URI = os.environ.get('MONGODB_URI') or 'mongodb://localhost:27017/microblog'
+    MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE') or 100)
+    MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE') or 0)
+    MONGO_MAX_IDLE_TIME_MS = int(os.environ.get('MONGO_MAX_IDLE_TIME_MS') or 0)
+    MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS') or 5000)
+    MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS') or 0)
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS') or 5000)
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS') or 0)
+    MONGO_COMPRESSORS = os.environ.get('MONGO_COMPRESSORS')
+    SLOW_QUERY_THRESHOLD_MS = int(os.environ.get('SLOW_QUERY_THRESHOLD_MS') or 100)
+    SLOW_QUERY_EXPLAIN_INTERVAL = int(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL') or 10)
+    SLOW_QUERY_SHAPE_TTL = int(os.environ.get('SLOW_QUERY_SHAPE_TTL') or 300)
+    SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG') or 'logs/slow_queries.log'
     USER_ID_FIELD = '_id'
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
@@ -10,5 +22,37 @@ class Config(object):
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['andreu77762@gmail.com']
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 20)
+    MAIL_MAX_RETRIES = int(os.environ.get('MAIL_MAX_RETRIES') or 3)
+    MAIL_RETRY_BACKOFF = float(os.environ.get('MAIL_RETRY_BACKOFF') or 1)
+    MAIL_ENQUEUE_TIMEOUT = float(os.environ.get('MAIL_ENQUEUE_TIMEOUT') or 0)
     LANGUAGES = ['en', 'es']
-    POSTS_PER_PAGE = 5
\ No newline at end of file
+    POSTS_PER_PAGE = 5
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE') or 10000)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL') or 300)
+    LAST_SEEN_FLUSH_INTERVAL = float(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 5)
+    LAST_SEEN_FLUSH_SIZE = int(os.environ.get('LAST_SEEN_FLUSH_SIZE') or 500)
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND') or 'memory'
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 5000)
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 600)
+    API_USERS_PER_PAGE = 100
+    API_USERS_MAX_PER_PAGE = 1000
+    API_STREAM_BATCH_SIZE = 500
+    API_LOOKUP_MAX_IDS = 100
+    API_POSTS_BATCH_MAX = 100
+    POST_MAX_LENGTH = 140
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 10000)
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 30)
+    TOKEN_CACHE_RECHECK = int(os.environ.get('TOKEN_CACHE_RECHECK') or 2)
+    SEARCH_ENGINE = os.environ.get('SEARCH_ENGINE') or 'mongo'
+    ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # each open stream holds a worker thread, only enable behind a threaded or async worker class
+    EVENTS_STREAMING = os.environ.get('EVENTS_STREAMING') is not None
+    EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE') or 100)
+    EVENTS_HEARTBEAT = int(os.environ.get('EVENTS_HEARTBEAT') or 15)
+    EVENTS_MAX_AGE = int(os.environ.get('EVENTS_MAX_AGE') or 300)
+    NOTIFICATION_TTL = int(os.environ.get('NOTIFICATION_TTL') or 7 * 24 * 3600)
\ No newline at end of file